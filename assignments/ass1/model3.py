@@ -10,6 +10,22 @@ author: Santiago Bonada
 license: BSD
 """
 
+import os
+import sys
+import matplotlib
+
+# offline rendering lives in shared/ at the top of the repository, use it
+# from there unless it is already importable (e.g. through PYTHONPATH)
+try:
+    import offline_render
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'shared'))
+    import offline_render
+
+# rendering a video offline does not need a display
+if offline_render.render_requested():
+    matplotlib.use('Agg')
+
 import numpy as np
 from matplotlib import pyplot as plt
 from matplotlib import animation
@@ -40,6 +56,14 @@ def init():
     frame_text.set_text('')
     return line, time_text, frame_text,
 
+# Draws frame i from the mass heights and time
+def draw_frame(i, frame):
+    ys, t = frame
+    line.set_data([0], ys)
+    time_text.set_text(time_template % t)
+    frame_text.set_text(frame_template % i)
+    return fig
+
 # Called at each frame
 def animate(i, slinky):
     ys = []
@@ -47,105 +71,107 @@ def animate(i, slinky):
     for mass in slinky.masses:
         ys.append(mass.y)
 
-    line.set_data([0], ys)
-    time_text.set_text(time_template % slinky.cur_time)
-    frame_text.set_text(frame_template % i)
+    draw_frame(i, (ys, slinky.cur_time))
 
     slinky.update()
     return line, time_text, frame_text,
 
-# Mass-Spring system
-class Mass:
-    def __init__(self, time, mass, y):
-        # state variables
-        self.y = y
-        self.vy = 0
-
-        self.held = False
-
-        self.adjacent = [] # adjacent masses
+# Runs the simulation without drawing, recording what each frame shows
+def precompute_frames(slinky, num_frames):
+    frames = []
+    for i in range(num_frames):
+        frames.append((np.array([mass.y for mass in slinky.masses]), slinky.cur_time))
+        slinky.update()
+    return frames
 
-        # constants
-        self.k = 2.3 # spring constant
-        self.m = mass # mass
-        self.c = 0.1 #damping constant
-        self.g = -9.8
-
-        self.solver = ode(self.ode_func)
-        self.solver.set_integrator("dop853")
-        self.solver.set_f_params(self.g,self.k,self.c,self.m)
-        self.solver.set_initial_value([self.y,self.vy],time)
+# A mass of the slinky, reads its entries of the slinky state
+class Mass:
+    def __init__(self, slinky, i):
+        self.slinky = slinky
+        self.i = i
 
-    def ode_func(self,t,state,gravity,spring_constant,damping,mass):
-        global rest_length
-        change = np.zeros(2)
-        change[0] = self.vy
-
-        dvy = gravity
-        # compute spring force for each adjacent mass
-        if self.held:
-            change[0] = 0
-            dvy = 0
-        else:
-            for other in self.adjacent:
-                distance = other.y - self.y
-                direction = distance/abs(distance)
-                spring_x = (rest_length - abs(distance))*direction
-                dvy += (-spring_constant*spring_x)/mass
-
-            # add damping
-            if DAMPING:
-                dvy += -damping*self.vy/mass
-
-        change[1] = dvy
+    @property
+    def y(self):
+        return self.slinky.state[self.i]
 
-        return change
+    @property
+    def vy(self):
+        return self.slinky.state[self.slinky.num_masses + self.i]
 
-    def update(self,cur_time):
-        if self.solver.successful():
-            self.solver.integrate(cur_time)
-            self.y = self.solver.y[0]
-            if self.held:
-                self.vy = 0
-            else:
-                self.vy = self.solver.y[1]
+    @property
+    def held(self):
+        return self.slinky.held[self.i]
 
+# Mass-Spring system, all masses are integrated together as one state
 class Slinky:
     def __init__(self, num_masses, length, height = 2):
-        self.masses = []
-
         self.cur_time = 0
         self.dt = 0.01
 
         self.top_above = True
 
-        # create masses
+        # constants
+        self.k = 2.3 # spring constant
+        self.m = total_mass/num_masses # mass of each mass
+        self.c = 0.1 #damping constant
+        self.g = -9.8
+
+        # state is the heights of all masses followed by their velocities,
+        # each mass is connected to the ones before and after it
+        self.num_masses = num_masses
         inter_len = length/num_masses
-        inter_mass = total_mass/num_masses
-        for i in range(num_masses):
-            self.masses.append(Mass(self.cur_time,inter_mass,height + i*inter_len))
-            # keep last mass held in place
-            if i == num_masses - 1:
-                self.masses[i].held = True
+        self.state = np.zeros(2*num_masses)
+        self.state[:num_masses] = height + np.arange(num_masses)*inter_len
+
+        # keep last mass held in place
+        self.held = np.zeros(num_masses, dtype=bool)
+        self.held[-1] = True
 
+        self.masses = [Mass(self, i) for i in range(num_masses)]
 
-        # connect masses
-        for i in range(num_masses):
-            if i > 0:
-                self.masses[i].adjacent.append(self.masses[i-1])
-            if i < len(self.masses) - 1:
-                self.masses[i].adjacent.append(self.masses[i+1])
+        self.solver = ode(self.ode_func)
+        self.solver.set_integrator("dop853")
+        self.solver.set_initial_value(self.state.copy(),self.cur_time)
+
+    def ode_func(self,t,state):
+        global rest_length
+        n = self.num_masses
+        ys = state[:n]
+        vys = state[n:]
+
+        # spring force between each pair of adjacent masses
+        distance = np.diff(ys)
+        tension = self.k*(np.abs(distance) - rest_length)*np.sign(distance)
+
+        dvy = np.full(n, self.g)
+        dvy[:-1] += tension/self.m
+        dvy[1:] -= tension/self.m
+
+        # add damping
+        if DAMPING:
+            dvy -= self.c*vys/self.m
+
+        change = np.concatenate((vys, dvy))
+        # held masses do not move
+        change[:n][self.held] = 0
+        change[n:][self.held] = 0
+        return change
+
+    def release(self, mass):
+        self.held[mass.i] = False
+        # the forces change, so restart the solver from the current state
+        self.solver.set_initial_value(self.state.copy(),self.cur_time)
 
     def update(self):
         self.cur_time += self.dt
-        for mass in self.masses:
-            mass.update(self.cur_time)
+        if self.solver.successful():
+            self.state[:] = self.solver.integrate(self.cur_time)
 
         # when bottom most mass is mostly motionless, release top
         bottom = self.masses[0]
         top = self.masses[len(self.masses)-1]
         if abs(bottom.vy) < 0.001 and top.held == True:
-            top.held = False
+            self.release(top)
             print "Top released with bottom at %f" % bottom.y
 
         # check when top reaches bottom
@@ -154,15 +180,29 @@ class Slinky:
             print "Top of slinky reached bottom of slinky at %f" % bottom.y
 
 
-slinky = Slinky(num_masses, length, start_height)
+def main():
+    slinky = Slinky(num_masses, length, start_height)
+
+    if offline_render.render_requested():
+        # e.g. --render --frames=18000 --output=slinky.mp4 for 10 minutes at 30 fps
+        num_frames = offline_render.option('frames', 18000)
+        frames = precompute_frames(slinky, num_frames)
+        returncode = offline_render.render_video(offline_render.option('output', 'basic_animation.mp4'),
+                                                 fig, draw_frame, frames, fps=offline_render.option('fps', 30))
+        offline_render.exit_on_failure(returncode)
+        return
+
+    # blit=True - only re-draw the parts that have changed.
+    # repeat=False - stops when frame count reaches 999
+    # fargs=(ball,) - a tuple that can be used to pass extra arguments to animate function
+    anim = animation.FuncAnimation(fig, animate, fargs=(slinky,), init_func=init, interval=10, blit=True, repeat=False)
 
-# blit=True - only re-draw the parts that have changed.
-# repeat=False - stops when frame count reaches 999
-# fargs=(ball,) - a tuple that can be used to pass extra arguments to animate function
-anim = animation.FuncAnimation(fig, animate, fargs=(slinky,), init_func=init, interval=10, blit=True, repeat=False)
+    # Save the animation as an mp4.  For more information, see
+    # http://matplotlib.sourceforge.net/api/animation_api.html
+    # anim.save('basic_animation.mp4', fps=30, extra_args=['-vcodec', 'libx264'])
 
-# Save the animation as an mp4.  For more information, see
-# http://matplotlib.sourceforge.net/api/animation_api.html
-# anim.save('basic_animation.mp4', fps=30, extra_args=['-vcodec', 'libx264'])
+    plt.show()
 
-plt.show()
+# worker processes import this module too, only the main one runs it
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-import pygame, sys
+import pygame, sys, os
 import matplotlib.pyplot as plt
 import numpy as np
 
@@ -13,21 +13,98 @@ BLUE = (0, 0, 255)
 # on all machines, regardless of the actual machine speed.
 clock = pygame.time.Clock()
 
-def array_to_csv(array):
-    csv = ""
-    for i in array:
-        csv += str(i)
-        if i != array[len(array)-1]:
-            csv += ","
-        else:
-            csv += "\n"
-    return csv
+# checkpoint of the last run, older runs were saved as text
+RESULTS_FILE = "results.npy"
+LEGACY_RESULTS_FILE = "results.txt"
 
 def csv_to_array(csv):
-    array = []
-    for i in csv.split(","):
-        array.append(float(i))
-    return array
+    return np.array(csv.split(","), dtype=np.float64)
+
+# Simulation results are stored as a single (3, n) float64 array saved in
+# the .npy format: row 0 holds times, row 1 positions and row 2 velocities,
+# each contiguous on disk. Files written by older versions used one line of
+# comma separated values per row, these are still readable.
+NPY_MAGIC = b'\x93NUMPY'
+
+def is_npy_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(NPY_MAGIC)) == NPY_MAGIC
+
+def save_trajectory(filename, data):
+    # write through a file object, np.save would append .npy to the name
+    with open(filename, 'wb') as f:
+        np.save(f, np.asarray(data, dtype=np.float64))
+
+def load_trajectory(filename):
+    '''returns the (3, n) trajectory array, memory mapped for .npy files'''
+    if is_npy_file(filename):
+        return np.load(filename, mmap_mode='r')
+
+    with open(filename, 'r') as f:
+        return np.array([csv_to_array(f.readline()) for i in range(3)])
+
+class TrajectoryRecorder:
+    '''Records (time, position, velocity) samples into a preallocated
+    (3, capacity) float64 buffer which grows by doubling when full.'''
+
+    def __init__(self, capacity=4096):
+        self.buf = np.empty((3, capacity))
+        self.n = 0
+
+    @classmethod
+    def from_data(cls, data):
+        '''wraps a (3, n) array without copying it, read-only (memory mapped)
+        arrays are copied into a writeable buffer on the first append'''
+        rec = cls(0)
+        rec.buf = np.asarray(data, dtype=np.float64)
+        rec.n = rec.buf.shape[1]
+        return rec
+
+    def __len__(self):
+        return self.n
+
+    def reserve(self, capacity):
+        if capacity > self.buf.shape[1] or not self.buf.flags.writeable:
+            buf = np.empty((3, max(capacity, 2*self.buf.shape[1])))
+            buf[:, :self.n] = self.buf[:, :self.n]
+            self.buf = buf
+
+    def append(self, t, y, vy):
+        if self.n == self.buf.shape[1] or not self.buf.flags.writeable:
+            self.reserve(self.n + 1)
+        self.buf[0, self.n] = t
+        self.buf[1, self.n] = y
+        self.buf[2, self.n] = vy
+        self.n += 1
+
+    def extend(self, times, positions, velocities):
+        m = len(times)
+        self.reserve(self.n + m)
+        self.buf[0, self.n:self.n+m] = times
+        self.buf[1, self.n:self.n+m] = positions
+        self.buf[2, self.n:self.n+m] = velocities
+        self.n += m
+
+    def clear(self):
+        self.n = 0
+
+    # the following are views into the buffer, they are only valid until
+    # the next append
+    @property
+    def data(self):
+        return self.buf[:, :self.n]
+
+    @property
+    def times(self):
+        return self.buf[0, :self.n]
+
+    @property
+    def positions(self):
+        return self.buf[1, :self.n]
+
+    @property
+    def velocities(self):
+        return self.buf[2, :self.n]
 
 def load_image(name):
     image = pygame.image.load(name)
@@ -56,6 +133,8 @@ class Simulation:
         self.g = -9.8 # gravity acts downwards
         self.dt = 0.033 # 33 millisecond, which corresponds to 30 fps
         self.cur_time = 0
+        self.trajectory = TrajectoryRecorder()
+        self.pending = [] # skipped segments not yet written to trajectory
 
         self.paused = True # starting in paused mode
 
@@ -65,18 +144,71 @@ class Simulation:
         self.mass = mass
         self.cur_time = t
 
-        self.times = [self.cur_time*1000]
-        self.positions = [self.y]
-        self.velocities = [self.vy]
+        self.pending = []
+        self.trajectory.clear()
+        self.trajectory.append(self.cur_time*1000, self.y, self.vy)
 
     def step(self):
         self.y += self.vy
         self.vy += self.mass * self.g * self.dt
         self.cur_time += self.dt
 
-        self.times.append(self.cur_time * 1000)
-        self.positions.append(self.y)
-        self.velocities.append(self.vy)
+        self.flush()
+        self.trajectory.append(self.cur_time * 1000, self.y, self.vy)
+
+    # step() is the linear recurrence y += vy, vy += a with a = mass*g*dt,
+    # so after k steps vy_k = vy + k*a and y_k = y + k*vy + a*k*(k-1)/2
+    def state_after(self, k):
+        a = self.mass * self.g * self.dt
+        return self.y + k*self.vy + a*k*(k-1)/2., self.vy + k*a
+
+    def advance(self, n_steps, record=True):
+        '''Jumps to the state n_steps calls of step() would reach in O(1).
+        With record the skipped samples are added to the trajectory lazily,
+        the next time it is read or stepped, otherwise only the final state
+        is recorded.'''
+        n = int(n_steps)
+        if n < 0:
+            raise ValueError("cannot advance by a negative number of steps")
+        if n == 0:
+            return
+
+        if record:
+            self.pending.append((self.cur_time, self.y, self.vy, self.mass * self.g * self.dt, self.dt, n))
+        self.y, self.vy = self.state_after(n)
+        self.cur_time += n * self.dt
+        if not record:
+            self.flush()
+            self.trajectory.append(self.cur_time * 1000, self.y, self.vy)
+
+    def seek(self, t, record=True):
+        '''advances to the step closest to time t (seconds)'''
+        n = int(round((t - self.cur_time) / self.dt))
+        if n < 0:
+            raise ValueError("cannot seek backwards from %f to %f" % (self.cur_time, t))
+        self.advance(n, record)
+
+    def flush(self):
+        '''writes the samples skipped by advance() into the trajectory'''
+        for t, y, vy, a, dt, n in self.pending:
+            k = np.arange(1, n+1, dtype=np.float64)
+            self.trajectory.extend((t + k*dt) * 1000, y + k*vy + a*k*(k-1)/2., vy + k*a)
+        self.pending = []
+
+    @property
+    def times(self):
+        self.flush()
+        return self.trajectory.times
+
+    @property
+    def positions(self):
+        self.flush()
+        return self.trajectory.positions
+
+    @property
+    def velocities(self):
+        self.flush()
+        return self.trajectory.velocities
 
     def pause(self):
         self.paused = True
@@ -85,25 +217,87 @@ class Simulation:
         self.paused = False
 
     def write_to_file(self,filename):
-        f = open(filename,'w')
-        f.write(array_to_csv(self.times))
-        f.write(array_to_csv(self.positions))
-        f.write(array_to_csv(self.velocities))
-        f.close
+        self.flush()
+        save_trajectory(filename, self.trajectory.data)
 
     def load_from_file(self,filename):
-        f = open(filename,'r')
-        line = f.readline()
-        self.times = csv_to_array(line)
+        self.pending = []
+        self.trajectory = TrajectoryRecorder.from_data(load_trajectory(filename))
+
+        self.cur_time = float(self.times[-1]) / 1000
+        self.y = float(self.positions[-1])
+        self.vy = float(self.velocities[-1])
+
+class BatchSimulation:
+    '''Headless counterpart of Simulation which advances many balls at
+    once, each with its own initial height, velocity and mass.'''
+
+    def __init__(self):
+        self.g = -9.8
+        self.dt = 0.033
+        self.floor = 0. # a ball has hit the ground once y drops below this
+        self.cur_time = 0
+
+    def setup(self, y, vy, mass, t = 0):
+        y, vy, mass = np.broadcast_arrays(y, vy, mass)
+        self.y = np.array(y, dtype=np.float64).ravel()
+        self.vy = np.array(vy, dtype=np.float64).ravel()
+        self.mass = np.array(mass, dtype=np.float64).ravel()
+        self.cur_time = t
 
-        line = f.readline()
-        self.positions = csv_to_array(line)
-        line = f.readline()
-        self.velocities = csv_to_array(line)
+        # time (ms) at which each ball was first seen below the floor
+        self.hit_times = np.full(len(self.y), np.nan)
+        self.active = self.y >= self.floor
+        self.hit_times[~self.active] = self.cur_time * 1000
 
-        self.cur_time = self.times[len(self.times)-1] / 1000
-        self.y = self.positions[len(self.positions)-1]
-        self.vy = self.velocities[len(self.velocities)-1]
+    def step(self):
+        '''same update as Simulation.step() for every ball, returns the mask
+        of balls that were still falling before this step'''
+        was_active = self.active.copy()
+        self.y += self.vy
+        self.vy += self.mass * self.g * self.dt
+        self.cur_time += self.dt
+
+        hit = was_active & (self.y < self.floor)
+        self.hit_times[hit] = self.cur_time * 1000
+        self.active &= ~hit
+        return was_active
+
+    def run(self, max_steps=100000, chunk=1024):
+        '''Steps until every ball has hit the floor (or max_steps). Returns
+        times (ms), positions and velocities where positions[i, j] is the
+        height of ball j after step i; entries after a ball has hit the
+        floor are nan.'''
+        n = len(self.y)
+        start_time = self.cur_time
+        blocks_y, blocks_vy = [], []
+        block_y = np.empty((chunk, n))
+        block_vy = np.empty((chunk, n))
+        block_y[0] = np.where(self.active, self.y, np.nan)
+        block_vy[0] = np.where(self.active, self.vy, np.nan)
+        row = 1
+        steps = 0
+        while self.active.any() and steps < max_steps:
+            if row == chunk:
+                blocks_y.append(block_y)
+                blocks_vy.append(block_vy)
+                block_y = np.empty((chunk, n))
+                block_vy = np.empty((chunk, n))
+                row = 0
+            recorded = self.step()
+            block_y[row] = self.y
+            block_vy[row] = self.vy
+            block_y[row, ~recorded] = np.nan
+            block_vy[row, ~recorded] = np.nan
+            row += 1
+            steps += 1
+        blocks_y.append(block_y[:row])
+        blocks_vy.append(block_vy[:row])
+
+        positions = np.concatenate(blocks_y)
+        velocities = np.concatenate(blocks_vy)
+        times = (start_time + self.dt * np.arange(steps + 1)) * 1000
+        return times, positions, velocities
 
 
 def sim_to_screen_y(win_height, y):
@@ -129,10 +323,12 @@ def main():
     # setting up simulation
     sim = Simulation()
     sim.setup(460, 0, 1)
-    #try:
-    sim.load_from_file("results.txt")
-    #except:
-        #print "No previous simulation results found, starting simulation from beginning"
+    if os.path.exists(RESULTS_FILE):
+        sim.load_from_file(RESULTS_FILE)
+    elif os.path.exists(LEGACY_RESULTS_FILE):
+        sim.load_from_file(LEGACY_RESULTS_FILE)
+    else:
+        print "No previous simulation results found, starting simulation from beginning"
 
 
     print '--------------------------------'
@@ -164,7 +360,7 @@ def main():
             sim.resume()
             continue
         elif event.type == pygame.KEYDOWN and event.key == pygame.K_q:
-            sim.write_to_file("results.txt")
+            sim.write_to_file(RESULTS_FILE)
             pygame.quit()
             break
         else:
@@ -187,27 +383,20 @@ def main():
             if event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE:
                 sim.step()
 
-    # Lets move our lists to numpy array
-    # first row contains times, second row contains positions
-    pos_vs_times = np.vstack([sim.times, sim.positions])
-    vel_vs_times = np.vstack([sim.times, sim.velocities]);
-
-    # Using matplotlib to plot simulation data
+    # Using matplotlib to plot simulation data, the recorder rows are
+    # already numpy arrays so no copies are made here
     plt.figure(1)
-    plt.plot(pos_vs_times[0,:], pos_vs_times[1,:])
+    plt.plot(sim.times, sim.positions)
     plt.xlabel('Time (ms)')
     plt.ylabel('y position')
     plt.title('Height vs. Time')
 
     plt.figure(2)
-    plt.plot(vel_vs_times[0,:], vel_vs_times[1,:])
+    plt.plot(sim.times, sim.velocities)
     plt.xlabel('Time (ms)')
     plt.ylabel('y velocity')
     plt.title('Velocity vs. Time')
     plt.show()
 
-
-    plt.plot(vel_vs_times[0,:], vel_vs_times[1,:])
-
 if __name__ == '__main__':
     main()
@@ -1,8 +1,11 @@
-import pygame, sys
+import pygame, sys, os
 import matplotlib.pyplot as plt
 import numpy as np
 import math
-from scipy.integrate import ode
+import hashlib
+from collections import OrderedDict
+import scipy.integrate
+from scipy.integrate import ode, solve_ivp
 
 # set up the colors
 BLACK = (0, 0, 0)
@@ -15,6 +18,10 @@ BLUE = (0, 0, 255)
 # on all machines, regardless of the actual machine speed.
 clock = pygame.time.Clock()
 
+# solve_ivp method used for dense output and event location, older scipy
+# versions only provide dop853 through ode() so fall back to RK45 there
+IVP_METHOD = 'DOP853' if hasattr(scipy.integrate, 'DOP853') else 'RK45'
+
 def load_image(name):
     image = pygame.image.load(name)
     return image
@@ -46,6 +53,9 @@ class Simulation:
         self.v = [0,0]
         self.angle = 0
 
+        self.ground = 0.
+        self.events = []
+
         self.solver = ode(self.f)
         self.solver.set_integrator("dop853")
         self.solver.set_f_params(self.g,self.friction)
@@ -80,12 +90,247 @@ class Simulation:
             self.trace_x.append(self.pos[0])
             self.trace_y.append(self.pos[1])
 
+    def add_event(self, event, terminal=False, direction=0):
+        '''registers event(t, state), its zero crossings are located by
+        find_events(); a terminal event stops the integration'''
+        event.terminal = terminal
+        event.direction = direction
+        self.events.append(event)
+
+    def find_events(self, t_max=1000., events=None):
+        '''Integrates from the current state with adaptive steps, at most
+        t_max seconds ahead. Event times are root-found on the integrator's
+        dense output, see the returned solution's t_events and sol(t).'''
+        if events is None:
+            events = self.events
+        state = [self.pos[0], self.pos[1], self.v[0], self.v[1]]
+        return solve_ivp(lambda t, y: self.f(t, y, self.g, self.friction),
+                         (self.cur_time, self.cur_time + t_max), state,
+                         method=IVP_METHOD, dense_output=True, events=events,
+                         rtol=1e-10, atol=1e-10)
+
+    def landing(self, t_max=1000.):
+        '''returns the time and state at which the projectile next falls
+        through the ground, or None if that does not happen within t_max'''
+        def hit_ground(t, state):
+            return state[1] - self.ground
+        hit_ground.terminal = True
+        hit_ground.direction = -1
+
+        solution = self.find_events(t_max, self.events + [hit_ground])
+        t_hits = solution.t_events[-1]
+        if len(t_hits) == 0:
+            return None
+        return t_hits[0], solution.sol(t_hits[0])
+
     def pause(self):
         self.paused = True
 
     def resume(self):
         self.paused = False
 
+def f_batch(t, state, gravity, friction):
+    '''Simulation.f for many projectiles at once, state is a flattened (4, N)
+    array of x, y, vx, vy rows and friction either a scalar or N values'''
+    state = state.reshape(4, -1)
+    change = np.empty_like(state)
+    change[0] = state[2]
+    change[1] = state[3]
+    change[2] = -state[2] * friction
+    change[3] = gravity
+    return change.ravel()
+
+def hermite(p0, m0, p1, m1, h, tau):
+    '''cubic Hermite interpolant on [0, h] of a value p with derivative m'''
+    s = tau / h
+    return ((2*s**3 - 3*s**2 + 1)*p0 + (s**3 - 2*s**2 + s)*h*m0
+            + (-2*s**3 + 3*s**2)*p1 + (s**3 - s**2)*h*m1)
+
+def hermite_slope(p0, m0, p1, m1, h, tau):
+    s = tau / h
+    return (6*s**2 - 6*s)*(p0 - p1)/h + (3*s**2 - 4*s + 1)*m0 + (3*s**2 - 2*s)*m1
+
+def bisect_interval(fun, h, n_iter=60):
+    '''vectorized bisection for the root of fun on [0, h], where fun(0) >= 0
+    and fun(h) <= 0 for every element'''
+    lo = np.zeros_like(h)
+    hi = h.copy()
+    for i in range(n_iter):
+        mid = (lo + hi) / 2.
+        above = fun(mid) > 0
+        lo = np.where(above, mid, lo)
+        hi = np.where(above, hi, mid)
+    return (lo + hi) / 2.
+
+def sweep(speeds, angles_degrees, frictions=0.05, gravity=-9.81, ground=0., dt=0.25, t_max=1000.):
+    '''Launches one projectile from the origin for every combination of the
+    broadcast speeds, angles and frictions, integrating all of them together
+    as a single dop853 system. Returns arrays of landing range, flight time
+    and apex height shaped like the broadcast inputs; the landing point is
+    found by root finding on a cubic Hermite interpolant between output
+    steps of size dt.'''
+    speeds, angles, frictions = np.broadcast_arrays(speeds, np.radians(angles_degrees), frictions)
+    shape = speeds.shape
+    speeds, angles = speeds.ravel(), angles.ravel()
+    frictions = np.array(frictions, dtype=np.float64).ravel()
+    n = len(speeds)
+
+    state = np.zeros((4, n))
+    state[2] = np.cos(angles) * speeds
+    state[3] = np.sin(angles) * speeds
+
+    ranges = np.full(n, np.nan)
+    flight_times = np.full(n, np.nan)
+    apexes = np.where(state[3] > 0, np.nan, 0.)
+    landed = np.zeros(n, dtype=bool)
+
+    solver = ode(f_batch)
+    solver.set_integrator("dop853", rtol=1e-10, atol=1e-10)
+    solver.set_f_params(gravity, frictions)
+    solver.set_initial_value(state.ravel(), 0.)
+
+    t = 0.
+    while not landed.all() and t < t_max and solver.successful():
+        solver.integrate(t + dt)
+        new_state = solver.y.reshape(4, n).copy()
+        dy0 = state[3]
+        dy1 = new_state[3]
+
+        peak = np.flatnonzero(np.isnan(apexes) & (dy1 <= 0))
+        if len(peak):
+            y0, v0, y1, v1, hp = state[1,peak], dy0[peak], new_state[1,peak], dy1[peak], np.full(len(peak), dt)
+            tau = bisect_interval(lambda tau: hermite_slope(y0, v0, y1, v1, hp, tau), hp)
+            apexes[peak] = hermite(y0, v0, y1, v1, hp, tau)
+
+        hit = np.flatnonzero(~landed & (new_state[1] <= ground))
+        if len(hit):
+            y0, v0, y1, v1, hh = state[1,hit], dy0[hit], new_state[1,hit], dy1[hit], np.full(len(hit), dt)
+            tau = bisect_interval(lambda tau: hermite(y0, v0, y1, v1, hh, tau) - ground, hh)
+            ranges[hit] = hermite(state[0,hit], state[2,hit], new_state[0,hit], new_state[2,hit], hh, tau)
+            flight_times[hit] = t + tau
+            landed[hit] = True
+
+        state = new_state
+        t += dt
+
+    return ranges.reshape(shape), flight_times.reshape(shape), apexes.reshape(shape)
+
+class RangeTable:
+    '''Landing range over a grid of launch angles, tabulated for a grid of
+    speeds and frictions and interpolated in between. Each (speed, friction)
+    grid point owns one slice of ranges over all angles; slices are computed
+    with sweep() when first needed, saved to cache_dir if given, and at most
+    max_slices of them are kept in memory, least recently used evicted first.'''
+
+    def __init__(self, speeds, frictions=[0.05], angles=np.linspace(0., 90., 361),
+                 gravity=-9.81, ground=0., cache_dir=None, max_slices=64):
+        self.speeds = np.sort(np.asarray(speeds, dtype=np.float64))
+        self.frictions = np.sort(np.asarray(frictions, dtype=np.float64))
+        self.angles = np.asarray(angles, dtype=np.float64)
+        self.gravity = gravity
+        self.ground = ground
+        self.cache_dir = cache_dir
+        # a query interpolates between up to 4 slices, which all have to fit
+        if max_slices < 4:
+            raise ValueError("max_slices must be at least 4")
+        self.max_slices = max_slices
+        self.slices = OrderedDict()
+
+        # cached slices are only reused by a table with the same model
+        # parameters, changing any of them changes the file names
+        params = (self.speeds.tolist(), self.frictions.tolist(), self.angles.tolist(), gravity, ground)
+        self.key = hashlib.sha1(repr(params).encode('ascii')).hexdigest()[:16]
+
+    def slice_file(self, i, j):
+        return os.path.join(self.cache_dir, 'range-%s-%d-%d.npy' % (self.key, i, j))
+
+    def store(self, i, j, ranges):
+        if self.cache_dir is not None:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            np.save(self.slice_file(i, j), ranges)
+        self.slices[(i, j)] = ranges
+        while len(self.slices) > self.max_slices:
+            self.slices.popitem(last=False)
+
+    def slice(self, i, j):
+        '''ranges over self.angles at speeds[i] and frictions[j]'''
+        ranges = self.slices.pop((i, j), None)
+        if ranges is not None:
+            self.slices[(i, j)] = ranges
+            return ranges
+
+        if self.cache_dir is not None and os.path.exists(self.slice_file(i, j)):
+            ranges = np.load(self.slice_file(i, j))
+        else:
+            ranges, t, apex = sweep(self.speeds[i], self.angles, self.frictions[j], self.gravity, self.ground)
+        self.store(i, j, ranges)
+        return ranges
+
+    def precompute(self, batch_size=65536):
+        '''computes every missing slice, sweeping about batch_size launches
+        at a time. Without a cache_dir the whole table has to fit in
+        max_slices.'''
+        if self.cache_dir is None and len(self.speeds) * len(self.frictions) > self.max_slices:
+            # the slices evicted from memory would have been swept for nothing
+            raise ValueError("precompute needs a cache_dir for tables of more than %d slices"
+                             % self.max_slices)
+        missing = [(i, j) for i in range(len(self.speeds)) for j in range(len(self.frictions))
+                   if (i, j) not in self.slices and
+                   (self.cache_dir is None or not os.path.exists(self.slice_file(i, j)))]
+        per_batch = max(1, batch_size // len(self.angles))
+        for b in range(0, len(missing), per_batch):
+            batch = missing[b:b+per_batch]
+            speeds = np.array([self.speeds[i] for i, j in batch])
+            frictions = np.array([self.frictions[j] for i, j in batch])
+            ranges, t, apex = sweep(speeds[None, :], self.angles[:, None], frictions[None, :],
+                                    self.gravity, self.ground)
+            for k, (i, j) in enumerate(batch):
+                self.store(i, j, ranges[:, k].copy())
+
+    def bracket(self, grid, value):
+        '''indices and weight for linear interpolation of value on grid'''
+        if not grid[0] <= value <= grid[-1]:
+            raise ValueError("%f is outside the table range [%f, %f]" % (value, grid[0], grid[-1]))
+        if len(grid) == 1:
+            return 0, 0, 0.
+        i = min(np.searchsorted(grid, value, side='right'), len(grid) - 1)
+        w = (value - grid[i-1]) / (grid[i] - grid[i-1])
+        return i-1, i, w
+
+    def scaled_slice(self, i, j):
+        '''ranges over self.angles at speeds[i] and frictions[j] divided by
+        the speed squared, which varies much less with the speed than the
+        ranges do. At speed 0 the next slice stands in for the limit.'''
+        if self.speeds[i] == 0:
+            i = min(i + 1, len(self.speeds) - 1)
+            if self.speeds[i] == 0:
+                return self.slice(i, j)
+        return self.slice(i, j) / self.speeds[i]**2
+
+    def ranges(self, speed, friction=0.05):
+        '''interpolated ranges over self.angles'''
+        i0, i1, wi = self.bracket(self.speeds, speed)
+        j0, j1, wj = self.bracket(self.frictions, friction)
+        # range grows about like the speed squared, so the speed is
+        # interpolated over ranges / speed**2
+        if wi == 0:
+            return (1-wj)*self.slice(i0, j0) + wj*self.slice(i0, j1)
+        return speed**2 * ((1-wi)*((1-wj)*self.scaled_slice(i0, j0) + wj*self.scaled_slice(i0, j1))
+                           + wi*((1-wj)*self.scaled_slice(i1, j0) + wj*self.scaled_slice(i1, j1)))
+
+    def angle_for_range(self, speed, target, friction=0.05, high=False):
+        '''Launch angle in degrees that lands at the target range, the flat
+        trajectory unless high is set. Returns None if out of reach.'''
+        ranges = self.ranges(speed, friction)
+        k = np.argmax(ranges)
+        if target > ranges[k] or target < 0:
+            return None
+        # range increases with the angle up to the maximum, then decreases
+        if high:
+            return np.interp(target, ranges[k:][::-1], self.angles[k:][::-1])
+        return np.interp(target, ranges[:k+1], self.angles[:k+1])
+
 def sim_to_screen(win_height, x, y):
     '''flipping y, since we want our y to increase as we move up'''
     x += 10
@@ -112,6 +357,7 @@ def main():
     # setting up simulation
     sim = Simulation()
     sim.setup(50., 45.)
+    t_land, land_state = sim.landing()
 
     print '--------------------------------'
     print 'Usage:'
@@ -159,7 +405,7 @@ def main():
             if event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE:
                 sim.step()
 
-    print sim.trace_x[len(sim.trace_x)-1]
+    print 'Range %f reached at t = %f' % (land_state[0], t_land)
 
     plt.figure(1)
     plt.plot(sim.trace_x, sim.trace_y)
@@ -1,4 +1,6 @@
 import math
+import time
+import threading
 
 import pygame, sys
 import matplotlib.pyplot as plt
@@ -18,6 +20,10 @@ Earth_Mass = 5.972e24 # kg
 Moon_Mass = 7.34767309e22 # kg
 Distance = 384400000. # m
 
+# Yoshida's 4th order scheme is three leapfrog steps of these fractions of dt
+YOSHIDA_W1 = 1. / (2. - 2.**(1./3.))
+YOSHIDA_W0 = -2.**(1./3.) * YOSHIDA_W1
+
 
 # clock object that ensure that animation has the same
 # on all machines, regardless of the actual machine speed.
@@ -28,6 +34,306 @@ def load_image(name):
     image = pygame.image.load(name)
     return image
 
+# Barnes-Hut gravity. Bodies are sorted along a Morton (z-order) curve so
+# that every quadtree cell is a contiguous run of the sorted bodies, the
+# tree is then built level by level and walked for many bodies at once.
+def spread_bits(x):
+    '''moves bit k of x to bit 2k'''
+    x = x & 0x00000000FFFFFFFF
+    x = (x | (x << 16)) & 0x0000FFFF0000FFFF
+    x = (x | (x << 8)) & 0x00FF00FF00FF00FF
+    x = (x | (x << 4)) & 0x0F0F0F0F0F0F0F0F
+    x = (x | (x << 2)) & 0x3333333333333333
+    x = (x | (x << 1)) & 0x5555555555555555
+    return x
+
+class QuadTree:
+    def __init__(self, pos, masses, max_depth=20):
+        self.max_depth = max_depth
+        self.lo = pos.min(axis=0)
+        self.size = max((pos.max(axis=0) - self.lo).max(), 1e-300) * (1 + 1e-12)
+
+        cells_per_side = 2**max_depth
+        ij = np.minimum(((pos - self.lo) / self.size * cells_per_side).astype(np.int64), cells_per_side - 1)
+        self.keys = spread_bits(ij[:, 0]) | (spread_bits(ij[:, 1]) << 1)
+        self.order = np.argsort(self.keys, kind='mergesort')
+        sorted_keys = self.keys[self.order]
+        sorted_masses = masses[self.order]
+        weighted_pos = sorted_masses[:, None] * pos[self.order]
+
+        # per level: cell keys, first sorted body, body count, mass and
+        # centre of mass; plus the range of child cells on the next level
+        self.levels = []
+        for level in range(max_depth + 1):
+            cell_keys = sorted_keys >> (2*(max_depth - level))
+            start = np.flatnonzero(np.r_[True, cell_keys[1:] != cell_keys[:-1]])
+            cell_keys = cell_keys[start]
+            count = np.diff(np.r_[start, len(sorted_keys)])
+            mass = np.add.reduceat(sorted_masses, start)
+            com = np.add.reduceat(weighted_pos, start) / np.maximum(mass, 1e-300)[:, None]
+            self.levels.append((cell_keys, start, count, mass, com))
+            if count.max() == 1:
+                break
+
+        self.children = []
+        for level in range(len(self.levels) - 1):
+            keys, next_keys = self.levels[level][0], self.levels[level+1][0]
+            self.children.append((np.searchsorted(next_keys, 4*keys), np.searchsorted(next_keys, 4*keys + 4)))
+
+    def width(self, level):
+        return self.size / 2**level
+
+    def cell_key(self, bodies, level):
+        return self.keys[bodies] >> (2*(self.max_depth - level))
+
+def expand_ranges(owners, start, stop):
+    '''for each owner i yields (owner, k) for every k in range(start[i], stop[i])'''
+    counts = stop - start
+    owners = np.repeat(owners, counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owners, np.repeat(start, counts) + offsets
+
+def barnes_hut_accelerations(pos, masses, G, theta=0.5, softening=0., block=4096):
+    '''Accelerations with far away groups of bodies replaced by their centre
+    of mass. A cell of width w at distance d is used as a whole when
+    w/d < theta and it does not contain the body itself.'''
+    tree = QuadTree(pos, masses)
+    acc = np.zeros_like(pos)
+    eps2 = softening * softening
+    n = len(pos)
+
+    def add(bodies, src_pos, src_mass):
+        d = src_pos - pos[bodies]
+        r2 = (d*d).sum(axis=1) + eps2
+        ok = r2 > 0
+        w = np.zeros_like(r2)
+        w[ok] = G * src_mass[ok] / (r2[ok] * np.sqrt(r2[ok]))
+        acc[:, 0] += np.bincount(bodies, weights=w * d[:, 0], minlength=n)
+        acc[:, 1] += np.bincount(bodies, weights=w * d[:, 1], minlength=n)
+
+    for first in range(0, n, block):
+        # frontier of (body, cell) pairs, starting with the root cell
+        bodies = np.arange(first, min(first + block, n))
+        cells = np.zeros(len(bodies), dtype=np.int64)
+        for level in range(len(tree.levels)):
+            keys, start, count, mass, com = tree.levels[level]
+            d = com[cells] - pos[bodies]
+            r2 = (d*d).sum(axis=1)
+            own = tree.cell_key(bodies, level) == keys[cells]
+            far = ~own & (tree.width(level)**2 < theta*theta * r2)
+            single = ~own & (count[cells] == 1)
+            accept = far | single
+            add(bodies[accept], com[cells[accept]], mass[cells[accept]])
+
+            rest = ~accept & (count[cells] > 1)
+            bodies, cells = bodies[rest], cells[rest]
+            if len(bodies) == 0:
+                break
+            if level == len(tree.levels) - 1:
+                # coincident bodies at the deepest level, sum them directly
+                bodies, members = expand_ranges(bodies, start[cells], start[cells] + count[cells])
+                members = tree.order[members]
+                other = members != bodies
+                add(bodies[other], pos[members[other]], masses[members[other]])
+                break
+            child_start, child_stop = tree.children[level]
+            bodies, cells = expand_ranges(bodies, child_start[cells], child_stop[cells])
+    return acc
+
+def direct_accelerations(pos, masses, G, softening=0., block=64, dtype=np.float64):
+    '''Exact pairwise summation with Plummer softening, broadcast over blocks
+    of `block` bodies at a time so the temporaries stay at block x N. With
+    dtype=np.float32 the pair terms are computed in single precision, relative
+    to the centre of the positions to keep the differences accurate.'''
+    p = pos - pos.mean(axis=0)
+    masses = np.asarray(masses, dtype=np.float64)
+    # positions and masses are scaled by powers of two to about 1, so r**3
+    # neither overflows nor underflows in single precision, and scaled back
+    # at the end
+    length = 2.0 ** np.frexp(np.abs(p).max(initial=0.))[1]
+    mass = 2.0 ** np.frexp(np.abs(masses).max(initial=0.))[1]
+    p = (p / length).astype(dtype)
+    x, y = p[:, 0].copy(), p[:, 1].copy()
+    gm = (masses / mass).astype(dtype)
+    eps2 = dtype(softening / length) ** 2
+    acc = np.empty(pos.shape)
+    for first in range(0, len(p), block):
+        dx = x[None, :] - x[first:first+block, None]
+        dy = y[None, :] - y[first:first+block, None]
+        w = dx * dx
+        w += dy * dy
+        w += eps2
+        # the body itself, or coincident bodies when there is no softening
+        same = w == 0
+        w[same] = 1
+        w *= np.sqrt(w)
+        np.divide(gm, w, out=w)
+        w[same] = 0
+        acc[first:first+block, 0] = (w * dx).sum(axis=1)
+        acc[first:first+block, 1] = (w * dy).sum(axis=1)
+    acc *= G * mass / (length * length)
+    return acc
+
+def accelerations_and_jerks(pos, vel, masses, G, targets, softening=0., block=64, dtype=np.float64):
+    '''accelerations and their time derivatives for the bodies in targets
+    due to all bodies, over blocks of `block` targets at a time so the
+    temporaries stay at block x N. With dtype=np.float32 the pair terms are
+    computed in single precision, scaled as in direct_accelerations.'''
+    masses = np.asarray(masses, dtype=np.float64)
+    length = speed = mass = 1.
+    if dtype != np.float64:
+        pos = pos - pos.mean(axis=0)
+        vel = vel - vel.mean(axis=0)
+        length = 2.0 ** np.frexp(np.abs(pos).max(initial=0.))[1]
+        speed = 2.0 ** np.frexp(np.abs(vel).max(initial=0.))[1]
+        mass = 2.0 ** np.frexp(np.abs(masses).max(initial=0.))[1]
+        pos = (pos / length).astype(dtype)
+        vel = (vel / speed).astype(dtype)
+        masses = (masses / mass).astype(dtype)
+    eps2 = dtype(softening / length) ** 2
+
+    # components are kept apart so the sums run along the contiguous axis
+    x, y = pos[:, 0].copy(), pos[:, 1].copy()
+    vx, vy = vel[:, 0].copy(), vel[:, 1].copy()
+    acc = np.empty((len(targets), 2))
+    jerk = np.empty((len(targets), 2))
+    for first in range(0, len(targets), block):
+        t = targets[first:first+block, None]
+        dx = x[None, :] - x[t]
+        dy = y[None, :] - y[t]
+        dvx = vx[None, :] - vx[t]
+        dvy = vy[None, :] - vy[t]
+        r2 = dx*dx + dy*dy + eps2
+        same = r2 == 0
+        r2[same] = 1
+        # rv becomes 3 (r.v) / r**2
+        rv = dx*dvx + dy*dvy
+        rv *= 3
+        rv /= r2
+        w = masses / (r2 * np.sqrt(r2))
+        w[same] = 0
+        acc[first:first+block, 0] = (w * dx).sum(axis=1)
+        acc[first:first+block, 1] = (w * dy).sum(axis=1)
+        jerk[first:first+block, 0] = (w * (dvx - rv * dx)).sum(axis=1)
+        jerk[first:first+block, 1] = (w * (dvy - rv * dy)).sum(axis=1)
+    acc *= G * mass / (length * length)
+    jerk *= G * mass * speed / (length * length * length)
+    return acc, jerk
+
+class BlockTimesteps:
+    '''4th order Hermite integration with individual block timesteps. Each
+    body steps by dt / 2**level, its level chosen from |a| / |jerk| so that
+    bodies in close encounters take small steps while the rest do not.
+    Within one outer step of dt time is counted in integer ticks of
+    dt / 2**max_level and only the bodies due at the next tick have their
+    forces evaluated, the others are merely predicted. Every tick still
+    predicts all N bodies, so this only pays off over a shared step when
+    force evaluations dominate: many bodies, few of them at deep levels.
+    The jerks need direct summation, Barnes-Hut is not supported.'''
+
+    def __init__(self, universe, eta=0.02, eta_start=0.01, max_level=30):
+        u = universe
+        if u.force_mode == 'barnes-hut' or (u.force_mode == 'auto' and len(u.state) > u.direct_max):
+            raise ValueError("hermite-block needs the jerks of direct summation, "
+                             "use force_mode='direct'")
+        self.universe = universe
+        self.eta = eta
+        self.max_level = max_level
+        self.force_evaluations = 0
+
+        all_bodies = np.arange(len(u.state))
+        self.acc, self.jerk = self.forces(u.state[:, 0:2], u.state[:, 2:4], all_bodies)
+        self.level = self.choose_level(self.acc, self.jerk, eta_start)
+        self.tick = np.zeros(len(u.state), dtype=np.int64)
+
+    def forces(self, pos, vel, targets):
+        u = self.universe
+        return accelerations_and_jerks(pos, vel, u.masses, u.G, targets, u.softening, dtype=u.force_dtype)
+
+    def choose_level(self, acc, jerk, eta):
+        a = np.sqrt((acc*acc).sum(axis=1))
+        j = np.sqrt((jerk*jerk).sum(axis=1))
+        ratio = np.ones(len(a))
+        np.divide(eta * a, j * self.universe.dt, out=ratio, where=j > 0)
+        level = np.ceil(-np.log2(np.clip(ratio, 2.**-self.max_level, 1.)))
+        return level.astype(np.int64)
+
+    def step(self):
+        '''advances every body by the universe's dt'''
+        u = self.universe
+        end = 2**self.max_level
+        unit = u.dt / end
+        x0, v0 = u.state[:, 0:2], u.state[:, 2:4]
+        self.tick[:] = 0
+        now = 0
+        while now < end:
+            # a body's time is always a multiple of its step, so the next
+            # tick is one step of the deepest level away and every level
+            # whose step divides it is due
+            now += 2**(self.max_level - int(self.level.max()))
+            aligned = (now & -now).bit_length() - 1
+            active = np.flatnonzero(self.level >= self.max_level - aligned)
+
+            # predict everybody to the current tick
+            tau = ((now - self.tick) * unit)[:, None]
+            t_jerk = tau * self.jerk
+            vp = t_jerk / 2
+            vp += self.acc
+            vp *= tau
+            xp = t_jerk / 6
+            xp += self.acc / 2
+            xp *= tau
+            xp += v0
+            xp *= tau
+            xp += x0
+            vp += v0
+
+            a1, j1 = self.forces(xp, vp, active)
+            self.force_evaluations += len(active)
+
+            # Hermite corrector for the active bodies
+            h = (2**(self.max_level - self.level[active]) * unit)[:, None]
+            a0, j0 = self.acc[active], self.jerk[active]
+            v1 = v0[active] + h*(a0 + a1)/2 + h*h*(j0 - j1)/12
+            x1 = x0[active] + h*(v0[active] + v1)/2 + h*h*(a0 - a1)/12
+            u.state[active, 0:2] = x1
+            u.state[active, 2:4] = v1
+            self.acc[active] = a1
+            self.jerk[active] = j1
+            self.tick[active] = now
+
+            # shrink freely, grow by one level at a time and only when the
+            # body's time is aligned to the longer step
+            wanted = self.choose_level(a1, j1, self.eta)
+            level = self.level[active]
+            grow = (wanted < level) & (self.max_level - level + 1 <= aligned)
+            level = np.where(wanted > level, wanted, np.where(grow, level - 1, level))
+            self.level[active] = np.minimum(level, self.max_level)
+
+def benchmark_forces(sizes=(100, 300, 1000, 3000, 10000, 30000, 100000), direct_max=10000, theta=0.5):
+    '''prints the force evaluation time against N for both force modes on a
+    random disk shaped cluster'''
+    print '%8s %12s %12s %12s' % ('N', 'direct (s)', 'bh (s)', 'bh rel err')
+    rnd = np.random.RandomState(0)
+    for n in sizes:
+        r = Distance * np.sqrt(rnd.uniform(0, 1, n))
+        phi = rnd.uniform(0, 2*math.pi, n)
+        pos = np.c_[r*np.cos(phi), r*np.sin(phi)]
+        masses = rnd.uniform(0.5, 1.5, n) * Moon_Mass
+
+        t = time.time()
+        bh = barnes_hut_accelerations(pos, masses, G, theta)
+        t_bh = time.time() - t
+
+        if n <= direct_max:
+            t = time.time()
+            exact = direct_accelerations(pos, masses, G)
+            t_direct = time.time() - t
+            err = np.median(np.linalg.norm(bh - exact, axis=1) / np.linalg.norm(exact, axis=1))
+            print '%8d %12.4f %12.4f %12.2e' % (n, t_direct, t_bh, err)
+        else:
+            print '%8d %12s %12.4f %12s' % (n, '-', t_bh, '-')
+
 class HeavenlyBody(pygame.sprite.Sprite):
 
     def __init__(self, name, mass, color=WHITE, radius=0, imagefile=None):
@@ -41,58 +347,83 @@ class HeavenlyBody(pygame.sprite.Sprite):
             pygame.draw.circle(self.image, color, (radius, radius), radius, radius)
 
         self.rect = self.image.get_rect()
-        self.pos = np.array([0,0])
-        self.vel = np.array([0,0])
         self.mass = mass
         self.radius = radius
         self.name = name
-        self.G = G
-        self.distances = []
-        self.cur_time = 0
-
-        self.objects = []
-
-        self.solver = ode(self.f)
-        self.solver.set_integrator("dop853")
-        self.solver.set_f_params(self.G,self.mass)
-
-    def f(self,t,state,G,mass):
-        change = [0.,0.,0.,0.]
-        force = np.array([0.,0.])
-        for o in self.objects:
-            if o != self.name:
-                other = self.objects[o]
-
-                d = (other.pos - self.pos)
-                r = np.linalg.norm(d)
-                u = d / r
-                f = u * G * mass * other.mass / (r*r)
-                force += f
 
-                if self.name == 'earth':
-                    self.distances.append(r)
+        # x, y, vx, vy; once the body is added to a Universe this becomes a
+        # view onto its row of the universe's state array
+        self.state = np.zeros(4)
+        self.universe = None
 
-        change[2:4] = force/mass
-        change[0:2] = state[2:4]
+    @property
+    def pos(self):
+        return self.state[0:2]
 
-        return change
+    @property
+    def vel(self):
+        return self.state[2:4]
 
     def set_pos(self, pos):
-        self.pos = np.array(pos)
+        self.state[0:2] = pos
+        if self.universe is not None:
+            self.universe.state_changed()
 
     def set_vel(self, vel):
-        self.vel = np.array(vel)
-
-    def initialize_solver(self):
-        self.solver.set_initial_value([self.pos[0],self.pos[1],self.vel[0],self.vel[1]],self.cur_time)
-
-    def update1(self, objects, dt):
-        self.objects = objects
-        self.cur_time += dt
-        if self.solver.successful():
-            self.solver.integrate(self.cur_time)
-            self.vel = self.solver.y[2:4]
-            self.pos = self.solver.y[0:2]
+        self.state[2:4] = vel
+        if self.universe is not None:
+            self.universe.state_changed()
+
+class DistanceRecorder:
+    '''Tracks the distance between two bodies once per step using constant
+    memory: running min, max, mean and standard deviation over every step,
+    and the last `capacity` (time, distance) samples taken every `every`
+    steps, kept in a ring buffer.'''
+
+    def __init__(self, a, b, capacity=10000, every=1):
+        self.a = a
+        self.b = b
+        self.every = every
+        self.samples = np.empty((capacity, 2))
+        self.stored = 0 # samples written so far, including overwritten ones
+        self.steps = 0
+
+        self.n = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.mean = 0.
+        self.m2 = 0. # sum of squared deviations from the mean (Welford)
+
+    def record(self, t):
+        d = self.a.pos - self.b.pos
+        r = math.sqrt(d[0]*d[0] + d[1]*d[1])
+
+        self.n += 1
+        delta = r - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (r - self.mean)
+        self.min = min(self.min, r)
+        self.max = max(self.max, r)
+
+        if self.steps % self.every == 0:
+            self.samples[self.stored % len(self.samples)] = t, r
+            self.stored += 1
+        self.steps += 1
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / self.n) if self.n else 0.
+
+    def history(self):
+        '''the kept samples as a (k, 2) array of time, distance, oldest first'''
+        capacity = len(self.samples)
+        if self.stored <= capacity:
+            return self.samples[:self.stored].copy()
+        return np.roll(self.samples, -(self.stored % capacity), axis=0)
+
+    def report(self):
+        print '%s-%s distance: min %.6e, max %.6e, mean %.6e, std %.3e over %d steps' % (
+            self.a.name, self.b.name, self.min, self.max, self.mean, self.std, self.n)
 
 class Universe:
     def __init__(self):
@@ -100,20 +431,209 @@ class Universe:
         self.objects_dict = {}
         self.objects = pygame.sprite.Group()
         self.dt = 100.0
+        self.cur_time = 0
+        self.G = G
+
+        # 'direct' sums every pair exactly, 'barnes-hut' approximates
+        # distant groups, theta is its opening angle; 'auto' uses direct
+        # summation up to direct_max bodies. force_dtype=np.float32 makes
+        # direct summation faster at the cost of precision
+        self.force_mode = 'auto'
+        self.direct_max = 2000
+        self.theta = 0.5
+        self.softening = 0.
+        self.force_dtype = np.float64
+
+        # 'dop853' (adaptive), or the fixed step symplectic 'leapfrog'
+        # (velocity Verlet) and 'yoshida4' which keep the energy error bounded,
+        # or 'hermite-block' which gives every body its own power of two
+        # fraction of dt
+        self.integrator = 'dop853'
+        self.block_timesteps = None
+
+        # all bodies are integrated together as a single system, row i of
+        # state holds x, y, vx, vy of bodies[i]. state and masses are views
+        # onto the first len(bodies) rows of buffers that double in size
+        # when full, so adding N bodies costs O(N)
+        self.bodies = []
+        self.state_buffer = np.zeros((0, 4))
+        self.mass_buffer = np.zeros(0)
+        self.state = self.state_buffer
+        self.masses = self.mass_buffer
+
+        self.solver = ode(self.f)
+        self.solver.set_integrator("dop853")
+        self.solver_ready = False
+        self.acc = None # accelerations at the current positions, if known
+        # copy of the state at the first step, drift() is measured from it
+        self.initial_state = None
+        self.initial_invariants = None
+        self.recorders = []
+
+    def state_changed(self):
+        self.solver_ready = False
+        self.acc = None
+        self.block_timesteps = None
+        self.initial_state = None
+        self.initial_invariants = None
 
     def add_body(self, body):
         self.objects_dict[body.name] = body
         self.objects.add(body)
 
+        n = len(self.bodies)
+        if n == len(self.state_buffer):
+            # reallocate, the bodies' views have to follow their rows
+            self.state_buffer = np.zeros((max(2*n, 16), 4))
+            self.state_buffer[:n] = self.state
+            self.mass_buffer = np.zeros(len(self.state_buffer))
+            self.mass_buffer[:n] = self.masses
+            for i, b in enumerate(self.bodies):
+                b.state = self.state_buffer[i]
+
+        self.bodies.append(body)
+        self.state_buffer[n] = body.state
+        self.mass_buffer[n] = body.mass
+        self.state = self.state_buffer[:n+1]
+        self.masses = self.mass_buffer[:n+1]
+        body.state = self.state_buffer[n]
+        body.universe = self
+        self.state_changed()
+
+    def add_recorder(self, recorder):
+        '''recorder.record(t) is called after every step'''
+        self.recorders.append(recorder)
+
+    def accelerations(self, pos):
+        mode = self.force_mode
+        if mode == 'auto':
+            mode = 'direct' if len(pos) <= self.direct_max else 'barnes-hut'
+
+        if mode == 'barnes-hut':
+            return barnes_hut_accelerations(pos, self.masses, self.G, self.theta, self.softening)
+        elif mode == 'direct':
+            return direct_accelerations(pos, self.masses, self.G, self.softening, dtype=self.force_dtype)
+        raise ValueError("unknown force mode %s" % self.force_mode)
+
+    def f(self, t, y):
+        state = y.reshape(-1, 4)
+        change = np.empty_like(state)
+        change[:, 0:2] = state[:, 2:4]
+        change[:, 2:4] = self.accelerations(state[:, 0:2])
+        return change.ravel()
+
+    def leapfrog_step(self, dt):
+        '''kick-drift-kick, the closing kick's forces are reused by the next step'''
+        pos = self.state[:, 0:2]
+        vel = self.state[:, 2:4]
+        if self.acc is None:
+            self.acc = self.accelerations(pos)
+        vel += 0.5 * dt * self.acc
+        pos += dt * vel
+        self.acc = self.accelerations(pos)
+        vel += 0.5 * dt * self.acc
+
+    def step(self):
+        '''advances the physics by dt'''
+        if self.initial_state is None:
+            self.initial_state = self.state.copy()
+
+        if self.integrator == 'dop853':
+            if not self.solver_ready:
+                self.solver.set_initial_value(self.state.ravel(), self.cur_time)
+                self.solver_ready = True
+            if self.solver.successful():
+                self.solver.integrate(self.cur_time + self.dt)
+                self.state[:] = self.solver.y.reshape(-1, 4)
+            self.acc = None
+            self.block_timesteps = None
+        elif self.integrator == 'hermite-block':
+            if self.block_timesteps is None:
+                self.block_timesteps = BlockTimesteps(self)
+            self.block_timesteps.step()
+            self.solver_ready = False
+            self.acc = None
+        else:
+            if self.integrator == 'leapfrog':
+                self.leapfrog_step(self.dt)
+            elif self.integrator == 'yoshida4':
+                for w in (YOSHIDA_W1, YOSHIDA_W0, YOSHIDA_W1):
+                    self.leapfrog_step(w * self.dt)
+            else:
+                raise ValueError("unknown integrator %s" % self.integrator)
+            self.solver_ready = False
+            self.block_timesteps = None
+        self.cur_time += self.dt
+
+        for recorder in self.recorders:
+            recorder.record(self.cur_time)
+
+    def run(self, n_steps):
+        for i in range(n_steps):
+            self.step()
+
+    def energy(self, state=None, block=64):
+        '''total energy of the given state, by default the current one. The
+        potential sums every pair once, over blocks of `block` bodies so the
+        temporaries stay at block x N.'''
+        if state is None:
+            state = self.state
+        pos = state[:, 0:2]
+        vel = state[:, 2:4]
+        m = self.masses
+        kinetic = 0.5 * (m * (vel*vel).sum(axis=1)).sum()
+        x, y = pos[:, 0].copy(), pos[:, 1].copy()
+        potential = 0.
+        for first in range(0, len(pos), block):
+            stop = min(first + block, len(pos))
+            # pairs (i, j) with first <= i < stop and j > i
+            dx = x[None, first+1:] - x[first:stop, None]
+            dy = y[None, first+1:] - y[first:stop, None]
+            w = dx * dx
+            w += dy * dy
+            w += self.softening**2
+            np.sqrt(w, out=w)
+            w[np.tril_indices(stop - first, -1, w.shape[1])] = np.inf
+            np.divide(m[None, first+1:], w, out=w)
+            potential -= self.G * np.dot(m[first:stop], w.sum(axis=1))
+        return kinetic + potential
+
+    def angular_momentum(self, state=None):
+        s = self.state if state is None else state
+        return (self.masses * (s[:, 0]*s[:, 3] - s[:, 1]*s[:, 2])).sum()
+
+    def drift(self):
+        '''relative change of energy and angular momentum since the first
+        step, the starting values are only computed when first asked for'''
+        if self.initial_state is None:
+            return 0., 0.
+        if self.initial_invariants is None:
+            self.initial_invariants = (self.energy(self.initial_state),
+                                       self.angular_momentum(self.initial_state))
+        e0, l0 = self.initial_invariants
+        return (self.energy() - e0) / abs(e0), (self.angular_momentum() - l0) / abs(l0)
+
+    def report(self):
+        de, dl = self.drift()
+        print '%s: t = %.0f s, relative energy drift %.3e, angular momentum drift %.3e' % (
+            self.integrator, self.cur_time, de, dl)
+        for recorder in self.recorders:
+            recorder.report()
+
     def to_screen(self, pos):
         return [int((pos[0] + 1.3*Distance)*640/self.w), int((pos[1] + 1.3*Distance)*640./self.h)]
 
     def update(self):
-        for o in self.objects_dict:
+        self.step()
+        self.update_sprites()
+
+    def update_sprites(self, state=None):
+        '''moves the sprites to the given state, by default the current one'''
+        if state is None:
+            state = self.state
+        for i, obj in enumerate(self.bodies):
             # Comput positions for screen
-            obj = self.objects_dict[o]
-            obj.update1(self.objects_dict, self.dt)
-            p = self.to_screen(obj.pos)
+            p = self.to_screen(state[i, 0:2])
 
             if False: # Set this to True to print the following values
                 print 'Name', obj.name
@@ -127,23 +647,84 @@ class Universe:
     def draw(self, screen):
         self.objects.draw(screen)
 
-def main():
+class PhysicsThread(threading.Thread):
+    '''Steps a universe in the background as fast as possible, publishing a
+    copy of its state at most every publish_interval seconds. Snapshots are
+    double buffered: the physics fills the back buffer and swaps it to the
+    front under a lock, readers hold the lock while using the front one.'''
+
+    def __init__(self, universe, n_steps, publish_interval=1./60):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.universe = universe
+        self.n_steps = n_steps
+        self.publish_interval = publish_interval
+        self.steps_done = 0
+
+        self.buffers = [universe.state.copy(), universe.state.copy()]
+        self.times = [universe.cur_time, universe.cur_time]
+        self.front = 0
+        self.lock = threading.Lock()
+        self.stop_requested = threading.Event()
+
+    def publish(self):
+        back = 1 - self.front
+        self.buffers[back][:] = self.universe.state
+        self.times[back] = self.universe.cur_time
+        with self.lock:
+            self.front = back
+
+    def run(self):
+        last_publish = time.time()
+        while self.steps_done < self.n_steps and not self.stop_requested.is_set():
+            self.universe.step()
+            self.steps_done += 1
+            now = time.time()
+            if now - last_publish >= self.publish_interval:
+                self.publish()
+                last_publish = now
+        self.publish()
+
+    def stop(self):
+        self.stop_requested.set()
+        self.join()
+
+    def snapshot(self):
+        '''use as "with thread.snapshot() as (t, state):", the state must not
+        be kept around after the with block'''
+        return Snapshot(self)
+
+class Snapshot:
+    def __init__(self, thread):
+        self.thread = thread
+
+    def __enter__(self):
+        self.thread.lock.acquire()
+        front = self.thread.front
+        return self.thread.times[front], self.thread.buffers[front]
+
+    def __exit__(self, *args):
+        self.thread.lock.release()
+
+def run_headless(universe, n_steps):
+    start = time.time()
+    universe.run(n_steps)
+    elapsed = time.time() - start
+    print '%d steps in %.2f s (%.0f steps/s)' % (n_steps, elapsed, n_steps / elapsed)
+    universe.report()
 
-    print 'Press q to quit'
+def main():
 
-    # Initializing pygame
-    pygame.init()
-    win_width = 640
-    win_height = 640
-    screen = pygame.display.set_mode((win_width, win_height))  # Top left corner is (0,0)
-    pygame.display.set_caption('Heavenly Bodies')
+    headless = '--headless' in sys.argv
 
     # Create a Universe object, which will hold our heavenly bodies (planets, stars, moons, etc.)
     universe = Universe()
+    for arg in sys.argv[1:]:
+        if arg.startswith('--integrator='):
+            universe.integrator = arg.split('=', 1)[1]
 
     earth = HeavenlyBody('earth', Earth_Mass, radius=32)
     earth.set_pos([0, 0])
-    earth.initialize_solver()
 
     v_orbital_m = math.sqrt(G*Earth_Mass/Distance)
     print "orbital velocity of moon %f" % v_orbital_m
@@ -151,37 +732,53 @@ def main():
     moon = HeavenlyBody('moon', Moon_Mass, WHITE, radius=10)
     moon.set_pos([int(Distance), 0])
     moon.set_vel([0, v_orbital_m]) # Initial velocity of our moon
-    moon.initialize_solver()
 
     universe.add_body(earth)
     universe.add_body(moon)
+    universe.add_recorder(DistanceRecorder(earth, moon, every=100))
 
     total_frames = 1000000
-    iter_per_frame = 120
-
-    frame = 0
-    while frame < total_frames:
-        #print 'Frame number', frame
-
-        event = pygame.event.poll()
-        if event.type == pygame.QUIT:
-            pygame.quit()
-            sys.exit(0)
-        elif event.type == pygame.KEYDOWN and event.key == pygame.K_q:
-            pygame.quit()
-            sys.exit(0)
-        else:
-            pass
 
-        universe.update()
-        if frame % iter_per_frame == 0:
-            screen.fill(BLACK) # clear the background
-            universe.draw(screen)
-            pygame.display.flip()
-        frame += 1
+    if headless:
+        run_headless(universe, total_frames)
+        return
+
+    print 'Press q to quit'
+
+    # Initializing pygame
+    pygame.init()
+    win_width = 640
+    win_height = 640
+    screen = pygame.display.set_mode((win_width, win_height))  # Top left corner is (0,0)
+    pygame.display.set_caption('Heavenly Bodies')
+
+    # the physics runs in its own thread at full speed, the window is
+    # redrawn from its latest snapshot at 30 fps
+    physics = PhysicsThread(universe, total_frames)
+    physics.start()
+
+    while physics.is_alive():
+        clock.tick(30)
+
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_q):
+                physics.stop()
+                universe.report()
+                pygame.quit()
+                sys.exit(0)
+
+        with physics.snapshot() as (t, state):
+            universe.update_sprites(state)
+        screen.fill(BLACK) # clear the background
+        universe.draw(screen)
+        pygame.display.flip()
 
+    universe.report()
     pygame.quit()
 
 
 if __name__ == '__main__':
-    main()
+    if '--benchmark' in sys.argv:
+        benchmark_forces()
+    else:
+        main()
@@ -6,10 +6,28 @@ license: BSD
 """
 
 
+import os
+import sys
+import math
+import itertools
+import matplotlib
+
+# offline rendering lives in shared/ at the top of the repository, use it
+# from there unless it is already importable (e.g. through PYTHONPATH)
+try:
+    import offline_render
+except ImportError:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'shared'))
+    import offline_render
+
+# rendering a video offline (--render) does not need a display
+if offline_render.render_requested():
+    matplotlib.use('Agg')
+
 import numpy as np
 from matplotlib import pyplot as plt
 from matplotlib import animation
-from scipy.integrate import ode
+from scipy.integrate import ode, solve_ivp
 
 # Setup figure
 fig = plt.figure(1)
@@ -23,21 +41,97 @@ plt.xlabel('Time')
 plt.ylabel('Height')
 
 
+# Points of a line that grows every frame
+class PlotBuffer:
+    '''Preallocated x, y storage which doubles when full. The line is given
+    slice views of it, so appending never copies the history. With window
+    set only the last window points are kept; with max_points set every
+    other point is dropped whenever the buffer fills and from then on only
+    every stride-th appended point is kept, so the line never has more
+    than max_points points.'''
+
+    def __init__(self, capacity=1024, window=None, max_points=None):
+        if window is not None and max_points is not None:
+            raise ValueError("use either window or max_points")
+        self.window = window
+        self.max_points = max_points
+        if window is not None:
+            capacity = 2*window
+        elif max_points is not None:
+            capacity = max_points
+        self.data = np.empty((2, capacity))
+        self.clear()
+
+    def clear(self):
+        self.start = 0
+        self.end = 0
+        self.stride = 1
+        self.appended = 0
+
+    def append(self, x, y):
+        self.appended += 1
+        if (self.appended - 1) % self.stride:
+            return
+
+        if self.end == self.data.shape[1]:
+            if self.window is not None:
+                # move the window to the front, once every window appends
+                kept = self.end - self.start
+                self.data[:, :kept] = self.data[:, self.start:self.end]
+                self.start, self.end = 0, kept
+            elif self.max_points is not None:
+                kept = self.data[:, 0:self.end:2]
+                self.end = kept.shape[1]
+                self.data[:, :self.end] = kept.copy()
+                self.stride *= 2
+                if (self.appended - 1) % self.stride:
+                    return
+            else:
+                data = np.empty((2, 2*self.data.shape[1]))
+                data[:, :self.end] = self.data[:, :self.end]
+                self.data = data
+
+        self.data[0, self.end] = x
+        self.data[1, self.end] = y
+        self.end += 1
+        if self.window is not None and self.end - self.start > self.window:
+            self.start = self.end - self.window
+
+    @property
+    def x(self):
+        return self.data[0, self.start:self.end]
+
+    @property
+    def y(self):
+        return self.data[1, self.start:self.end]
+
+trace = PlotBuffer()
+
 # Background for each function
 def init():
+    trace.clear()
     line.set_data([], [])
     time_text.set_text('')
     return line, time_text,
 
 # Called at each frame
 def animate(i, ball):
-    line.set_xdata(np.append(line.get_xdata(), ball.t))
-    line.set_ydata(np.append(line.get_ydata(), ball.state[0]))
+    trace.append(ball.t, ball.state[0])
+    line.set_data(trace.x, trace.y)
     time_text.set_text(time_template % ball.t)
 
     ball.update()
     return line, time_text,
 
+def time_to_floor(y, vy, g):
+    '''time until a ball at height y with velocity vy falls to the floor
+    under constant gravity g, the positive root of y + vy*t - g*t*t/2 = 0'''
+    root = math.sqrt(vy*vy + 2*g*y)
+    # two equivalent forms of the root, use the one without cancellation
+    if vy >= 0:
+        return (vy + root) / g
+    return 2*y / (root - vy)
+
 # Ball simulation - bouncing ball
 class Ball:
     def __init__(self):
@@ -49,7 +143,9 @@ class Ball:
         self.t = 0
         self.mass = 1
 
-        self.tol_distance = 0.000001
+        # f is constant gravity, so contact times have a closed form; set
+        # this to False when f is changed to use the dense output instead
+        self.constant_gravity = True
 
         # We plan to use rk4
         self.solver = ode(self.f)
@@ -62,37 +158,33 @@ class Ball:
     def is_collision(self, state):
         return state[0] <= 0
 
-    def respond_to_collision(self, state, t):
-        # ground will be between this time interval
-        bot_dt = 0.0
-        top_dt = -self.dt
-
-        # original state
-        o_y = state[0]
-        o_vy = state[1]
-        o_t = t - self.dt
-
-        # height we binary search on
-        cur_y = o_y
-        while abs(cur_y) > self.tol_distance:
-            mid_dt = (top_dt+bot_dt)/2.0
-            top_vy = top_dt*self.g + o_vy
-            mid_vy = mid_dt*self.g + o_vy
-            bot_vy = bot_dt*self.g + o_vy
-
-            top_y = (top_dt)*top_vy + o_y
-            mid_y = (mid_dt)*mid_vy + o_y
-            bot_y = (bot_dt)*bot_vy + o_y
-
-            if abs(top_y) > abs(bot_y):
-                top_dt = mid_dt
-            else:
-                bot_dt = mid_dt
+    def contact_time(self, state):
+        return time_to_floor(state[0], state[1], self.g)
+
+    def dense_contact_time(self, state, t):
+        '''time until the ball falls to the floor from state at t, located
+        on the integrator's dense output, and the state at contact'''
+        def floor(t, y):
+            return y[0]
+        floor.terminal = True
+        floor.direction = -1
+
+        solution = solve_ivp(self.f, (t, t + self.dt), state, events=floor,
+                             dense_output=True, rtol=1e-12, atol=1e-12)
+        t_contact = solution.t_events[0][0]
+        return t_contact - t, solution.sol(t_contact)
 
-            cur_y = mid_y
-            t = o_t + mid_dt
+    def respond_to_collision(self, state, t):
+        # state and t are from the start of the step which ended below the
+        # floor, returns the bounced state at the moment of contact
+        if self.constant_gravity:
+            dt = self.contact_time(state)
+            vy = state[1] - self.g*dt
+        else:
+            dt, contact = self.dense_contact_time(state, t)
+            vy = contact[1]
 
-        return [cur_y, -1*state[1]], t
+        return [0., -vy], t + dt
 
     def update(self):
         new_state = self.solver.integrate(self.t + self.dt)
@@ -102,21 +194,158 @@ class Ball:
             self.state = new_state
             self.t += self.dt
         else:
-            state_after_collision, collision_time = self.respond_to_collision(new_state, self.t+self.dt)
+            state_after_collision, collision_time = self.respond_to_collision(self.state, self.t)
             self.state = state_after_collision
             self.t = collision_time
             self.solver.set_initial_value(self.state, self.t)
 
-ball = Ball()
+# Event driven bouncing ball - jumps from impact to impact
+class EventDrivenBall:
+    '''Between impacts the ball follows a parabola, so instead of stepping
+    the impacts are computed directly: every bounce scales the upward speed
+    by the restitution and the next flight lasts 2*speed/g. A ball whose
+    bounce speed drops below rest_speed stays at rest on the floor, with
+    rest_speed <= 0 it keeps bouncing.'''
+
+    def __init__(self, y=100., vy=0., g=9.8, restitution=1.0, rest_speed=1e-3):
+        if not 0 <= restitution <= 1:
+            raise ValueError("restitution must be between 0 and 1")
+        self.y0 = y
+        self.vy0 = vy
+        self.g = g
+        self.restitution = restitution
+        self.rest_speed = rest_speed
+
+    def run(self, max_bounces=1000000, t_end=None):
+        '''Computes up to max_bounces impacts, or just enough to reach t_end.
+        impact_times[k] is the k-th impact and launch_speeds[k] the upward
+        speed after it; rest_time is when the ball came to rest, if it did.'''
+        g, e = self.g, self.restitution
+        first = time_to_floor(self.y0, self.vy0, g)
+        speed = e * (g*first - self.vy0)
+
+        # the ball comes to rest after the first n bounces, unless e == 1 or
+        # rest_speed <= 0, which never stop it
+        at_rest = True
+        if speed == 0 or speed < self.rest_speed:
+            # also covers e == 0, the ball stops at the first impact
+            n = 0
+        elif e < 1 and self.rest_speed > 0:
+            # speed*e**k >= rest_speed for the first n bounces
+            n = int(math.floor(math.log(self.rest_speed / speed) / math.log(e))) + 1
+        else:
+            n = max_bounces
+            at_rest = False
+        if n > max_bounces:
+            n = max_bounces
+            at_rest = False
+        if t_end is not None and e == 1 and speed > 0:
+            n = min(n, max(int(math.ceil((t_end - first) * g / (2*speed))), 0) + 1)
+
+        self.launch_speeds = speed * e ** np.arange(n)
+        self.impact_times = np.empty(n + 1)
+        self.impact_times[0] = first
+        np.cumsum(2 * self.launch_speeds / g, out=self.impact_times[1:])
+        self.impact_times[1:] += first
+
+        self.rest_time = self.impact_times[-1] if at_rest else None
+        if t_end is not None:
+            k = np.searchsorted(self.impact_times, t_end, side='right')
+            self.launch_speeds = self.launch_speeds[:k]
+            self.impact_times = self.impact_times[:k+1]
+            if k < n:
+                self.rest_time = None
+        return self.impact_times
+
+    def states_at(self, times):
+        '''heights and velocities at the given times, nan past the last
+        computed impact unless the ball came to rest'''
+        t = np.asarray(times, dtype=np.float64)
+        y = np.full(t.shape, np.nan)
+        vy = np.full(t.shape, np.nan)
+
+        before = t < self.impact_times[0]
+        tau = t[before]
+        y[before] = self.y0 + self.vy0*tau - self.g*tau*tau/2
+        vy[before] = self.vy0 - self.g*tau
+
+        k = np.searchsorted(self.impact_times, t, side='right') - 1
+        flying = (k >= 0) & (k < len(self.launch_speeds))
+        tau = t[flying] - self.impact_times[k[flying]]
+        speed = self.launch_speeds[k[flying]]
+        y[flying] = speed*tau - self.g*tau*tau/2
+        vy[flying] = speed - self.g*tau
+
+        if self.rest_time is not None:
+            resting = t >= self.rest_time
+            y[resting] = 0.
+            vy[resting] = 0.
+        return y, vy
+
+    def iter_states(self, times, chunk=65536):
+        '''yields (t, y, vy) arrays for an iterable of sample times, taking
+        at most chunk times from it at a time'''
+        times = iter(times)
+        while True:
+            t = np.fromiter(itertools.islice(times, chunk), dtype=np.float64)
+            if len(t) == 0:
+                return
+            y, vy = self.states_at(t)
+            yield t, y, vy
+
+# Offline rendering - the trajectory is computed up front, then the frames
+# are drawn by a pool of processes and piped to ffmpeg in order
+def precompute_trajectory(ball, num_frames):
+    times = np.empty(num_frames)
+    heights = np.empty(num_frames)
+    for i in range(num_frames):
+        times[i] = ball.t
+        heights[i] = ball.state[0]
+        ball.update()
+    return times, heights
+
+# Frame i of the offline video shows the trajectory up to sample i
+class TraceFrames:
+    def __init__(self, times, heights):
+        self.times = times
+        self.heights = heights
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, i):
+        return self.times[:i+1], self.heights[:i+1]
+
+def draw_frame(i, frame):
+    times, heights = frame
+    line.set_data(times, heights)
+    time_text.set_text(time_template % times[-1])
+    return fig
+
+def main():
+    ball = Ball()
+
+    if offline_render.render_requested():
+        # e.g. --render --frames=18000 --output=ball.mp4 for 10 minutes at 30 fps
+        num_frames = offline_render.option('frames', 300)
+        frames = TraceFrames(*precompute_trajectory(ball, num_frames))
+        returncode = offline_render.render_video(offline_render.option('output', 'basic_animation.mp4'),
+                                                 fig, draw_frame, frames, fps=offline_render.option('fps', 30))
+        offline_render.exit_on_failure(returncode)
+        return
+
+    # blit=True - only re-draw the parts that have changed.
+    # repeat=False - stops when frame count reaches 999
+    # fargs=(ball,) - a tuple that can be used to pass extra arguments to animate function
+    anim = animation.FuncAnimation(fig, animate, fargs=(ball,), init_func=init, frames=300, interval=10, blit=True, repeat=False)
+    #plt.savefig('bouncing-ball-trace', format='png')
 
-# blit=True - only re-draw the parts that have changed.
-# repeat=False - stops when frame count reaches 999
-# fargs=(ball,) - a tuple that can be used to pass extra arguments to animate function
-anim = animation.FuncAnimation(fig, animate, fargs=(ball,), init_func=init, frames=300, interval=10, blit=True, repeat=False)
-#plt.savefig('bouncing-ball-trace', format='png')
+    # Save the animation as an mp4.  For more information, see
+    # http://matplotlib.sourceforge.net/api/animation_api.html
+    # anim.save('basic_animation.mp4', fps=30, extra_args=['-vcodec', 'libx264'])
 
-# Save the animation as an mp4.  For more information, see
-# http://matplotlib.sourceforge.net/api/animation_api.html
-# anim.save('basic_animation.mp4', fps=30, extra_args=['-vcodec', 'libx264'])
+    plt.show()
 
-plt.show()
+# worker processes import this module too, only the main one runs it
+if __name__ == '__main__':
+    main()
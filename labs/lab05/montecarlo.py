@@ -0,0 +1,84 @@
+"""
+Batched Monte Carlo integration over the unit hypercube
+
+An integrand is a vectorized function taking a (batch, d) array of points
+and returning the batch of values. The samples are split into blocks of
+BLOCK_SIZE, block b draws its points from its own generator seeded with the
+key [rnd_seed, b], so the result does not depend on how many processes
+share the blocks. Within a block only chunk_size points are held at a time.
+"""
+
+import multiprocessing
+import numpy as np
+
+BLOCK_SIZE = 2**22
+
+def block_rng(rnd_seed, block):
+    return np.random.RandomState([rnd_seed, block])
+
+def map_blocks(func, blocks, processes):
+    if processes == 1:
+        return map(func, blocks)
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(func, blocks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def combine(a, b):
+    '''merges two (n, sum, M2) accumulators, M2 being the sum of squared
+    deviations from the mean'''
+    n_a, total_a, m2_a = a
+    n_b, total_b, m2_b = b
+    n = n_a + n_b
+    if n_a == 0 or n_b == 0:
+        return n, total_a + total_b, m2_a + m2_b
+    delta = total_b / n_b - total_a / n_a
+    return n, total_a + total_b, m2_a + m2_b + delta * delta * n_a * n_b / n
+
+class PowerProposal:
+    '''Importance sampling density prod alpha_i * x_i**(alpha_i - 1) on the
+    unit hypercube, alpha > 1 puts more samples near 1 and alpha < 1 near 0.
+    Any object with the same sample(rng, n) and pdf(x) methods can be used
+    as a proposal.'''
+    def __init__(self, alpha):
+        self.alpha = np.asarray(alpha, dtype=np.float64)
+
+    def sample(self, rng, n):
+        return rng.random_sample((n, len(self.alpha))) ** (1.0 / self.alpha)
+
+    def pdf(self, x):
+        return np.prod(self.alpha * x ** (self.alpha - 1.0), axis=1)
+
+def block_sums(args):
+    '''(n, sum, M2) of the integrand values, weighted by the proposal if
+    there is one, over one block'''
+    integrand, d, rnd_seed, block, n_samples, chunk_size, proposal = args
+    rng = block_rng(rnd_seed, block)
+    acc = (0, 0.0, 0.0)
+    for first in range(0, n_samples, chunk_size):
+        n = min(chunk_size, n_samples - first)
+        if proposal is None:
+            f = integrand(rng.random_sample((n, d)))
+        else:
+            x = proposal.sample(rng, n)
+            f = integrand(x) / proposal.pdf(x)
+        # each batch adds its own mean and spread, not raw sums of squares
+        mean = f.mean()
+        acc = combine(acc, (n, f.sum(), np.dot(f - mean, f - mean)))
+    return acc
+
+def integrate(integrand, d, n_samples, rnd_seed=0, chunk_size=2**20, processes=1, proposal=None):
+    '''Estimates the integral of integrand over the d dimensional unit
+    hypercube from n_samples points, or the expectation of integrand / pdf
+    under the proposal, returning (estimate, standard error). With
+    processes other than 1 the blocks are shared by worker processes, the
+    integrand and proposal then have to be picklable (module level).'''
+    blocks = [(integrand, d, rnd_seed, b, min(BLOCK_SIZE, n_samples - first), chunk_size, proposal)
+              for b, first in enumerate(range(0, n_samples, BLOCK_SIZE))]
+    acc = (0, 0.0, 0.0)
+    for sums in map_blocks(block_sums, blocks, processes):
+        acc = combine(acc, sums)
+    n, total, m2 = acc
+    return total / n, np.sqrt(m2 / (n - 1) / n) if n > 1 else np.inf
@@ -1,28 +1,400 @@
+import sys
+import math
 import time
 import numpy as np
+from montecarlo import BLOCK_SIZE, block_rng, map_blocks, integrate
 
 N_RUNS = 2
 
-def estimate_pi(n_samples,rnd_seed=0):
-    np.random.seed(rnd_seed)
-    samples_x = np.random.uniform(0,1,n_samples)
-    samples_y = np.random.uniform(0,1,n_samples)
-    distances = np.sqrt(np.power(samples_x,2) + np.power(samples_y,2))
-    return 4.0 * np.sum(distances <= 1.0) / float(n_samples)
-
-averages = []
-deviation = []
-for i in range(2,9):
-    total = 0
-    approx = []
-    for run in range(N_RUNS):
-        n_samples = pow(10,i)
-        approx.append(estimate_pi(n_samples,run))
-    print "Aproximation", approx,pow(10,i)
-    average = np.mean(approx)
-    averages.append(average)
-    deviation.append(np.abs(np.array(approx) - average))
-
-deviation = np.array(deviation)
-print "Averages: ", averages
-print "Deviation from average", deviation
+# In floating point sqrt(s) <= 1 holds exactly when s <= 1 + eps, so the
+# squared distance can be compared against this instead of taking the sqrt
+INSIDE = 1.0 + np.finfo(np.float64).eps
+
+def count_inside(x, y):
+    '''number of points (x, y) inside the unit circle, overwrites x and y'''
+    np.multiply(x, x, out=x)
+    np.multiply(y, y, out=y)
+    np.add(x, y, out=x)
+    # the comparison result is written over the no longer needed y
+    return np.count_nonzero(np.less_equal(x, INSIDE, out=y.view(np.bool_)[:len(x)]))
+
+# For parallel runs the samples come from the block streams of the
+# montecarlo engine, see BLOCK_SIZE there
+def quarter_disc(xy):
+    '''4 inside the unit circle and 0 outside, for the rows of the (n, 2)
+    array xy'''
+    return 4.0 * (np.square(xy).sum(axis=1) <= INSIDE)
+
+def count_inside_pairs(xy):
+    '''number of rows of the (n, 2) array xy inside the unit circle,
+    overwrites xy'''
+    np.multiply(xy, xy, out=xy)
+    return np.count_nonzero(xy[:, 0] + xy[:, 1] <= INSIDE)
+
+def count_antithetic(xy):
+    '''numbers of pairs (x, y), (1-x, 1-y) with 0, 1 and 2 of their points
+    inside the unit circle, for the rows of the (n, 2) array xy, overwrites
+    xy'''
+    h = (np.einsum('ij,ij->i', xy, xy) <= INSIDE).astype(np.int64)
+    np.subtract(1.0, xy, out=xy)
+    h += np.einsum('ij,ij->i', xy, xy) <= INSIDE
+    return np.bincount(h, minlength=3)
+
+def count_block_prefixes(args):
+    '''inside counts of the first k samples of a block for each k in the
+    sorted list offsets'''
+    rnd_seed, block, offsets, chunk_size = args
+    rng = block_rng(rnd_seed, block)
+    counts = []
+    inside = 0
+    done = 0
+    for offset in offsets:
+        while done < offset:
+            n = min(chunk_size, offset - done)
+            inside += count_inside_pairs(rng.random_sample((n, 2)))
+            done += n
+        counts.append(inside)
+    return counts
+
+# Other samplers estimate_pi can use. Stratified, sobol and halton give
+# their error from REPLICATES independently randomized replicates of
+# n_samples / REPLICATES points each
+REPLICATES = 16
+
+# Joe and Kuo direction numbers (s, a, m_1 .. m_s) of the Sobol sequence for
+# dimensions 2 to 8, dimension 1 is the base 2 van der Corput sequence
+SOBOL_TABLE = [
+    (1, 0, [1]),
+    (2, 1, [1, 3]),
+    (3, 1, [1, 3, 1]),
+    (3, 2, [1, 1, 1]),
+    (4, 1, [1, 1, 3, 3]),
+    (4, 4, [1, 3, 5, 13]),
+    (5, 2, [1, 1, 5, 5, 17]),
+]
+SOBOL_BITS = 32
+
+def sobol_directions(bits=SOBOL_BITS):
+    '''(dimensions, bits) array of direction numbers, row d bit k is v_k+1
+    of dimension d+1 scaled to bits bits'''
+    V = np.zeros((len(SOBOL_TABLE) + 1, bits), dtype=np.uint64)
+    V[0] = [1 << (bits - 1 - k) for k in range(bits)]
+    for d, (s, a, m) in enumerate(SOBOL_TABLE, 1):
+        v = [m_k << (bits - 1 - k) for k, m_k in enumerate(m)]
+        for k in range(s, bits):
+            x = v[k - s] ^ (v[k - s] >> s)
+            for i in range(1, s):
+                if (a >> (s - 1 - i)) & 1:
+                    x ^= v[k - i]
+            v.append(x)
+        V[d] = v[:bits]
+    return V.astype(np.uint32)
+
+SOBOL_V = sobol_directions()
+
+def sobol_points(first, n, shift):
+    '''points first .. first+n-1 of the Sobol sequence in len(shift)
+    dimensions as an (n, d) array, digitally shifted by xor with the integer
+    vector shift'''
+    index = np.arange(first, first + n, dtype=np.int64)
+    bits = np.zeros((n, len(shift)), dtype=np.uint32)
+    for k in range(int(first + n).bit_length()):
+        bit = ((index >> k) & 1).astype(np.uint32)
+        for d in range(len(shift)):
+            bits[:, d] ^= bit * SOBOL_V[d, k]
+    bits ^= np.asarray(shift, dtype=np.uint32)
+    return bits * 2.0**-SOBOL_BITS
+
+HALTON_BASES = [2, 3, 5, 7, 11, 13, 17, 19]
+
+def halton_points(first, n, shift):
+    '''points first .. first+n-1 of the Halton sequence in len(shift)
+    dimensions as an (n, d) array, shifted by shift modulo 1'''
+    xs = np.empty((n, len(shift)))
+    for d, base in enumerate(HALTON_BASES[:len(shift)]):
+        index = np.arange(first, first + n, dtype=np.int64)
+        x = np.zeros(n)
+        scale = 1.0 / base
+        while index.any():
+            x += scale * (index % base)
+            index //= base
+            scale /= base
+        xs[:, d] = x
+    xs += shift
+    return np.mod(xs, 1.0, out=xs)
+
+def sobol_shift(rng, d):
+    return rng.randint(0, 2**SOBOL_BITS, size=d, dtype=np.uint64).astype(np.uint32)
+
+def halton_shift(rng, d):
+    return rng.random_sample(d)
+
+def replicate_estimate(estimates):
+    '''mean of the replicate estimates and its standard error'''
+    estimates = np.asarray(estimates)
+    return estimates.mean(), estimates.std(ddof=1) / np.sqrt(len(estimates))
+
+def estimate_qmc(points, shift, n_samples, rnd_seed, chunk_size, replicates=REPLICATES):
+    '''randomized quasi Monte Carlo, every replicate counts the same first
+    n_samples // replicates points of the sequence under its own random
+    shift, the other n_samples % replicates samples are not used'''
+    if n_samples < replicates:
+        raise ValueError('need at least %d samples, one per replicate' % replicates)
+    rng = np.random.RandomState(rnd_seed)
+    n = n_samples // replicates
+    estimates = []
+    for r in range(replicates):
+        u = shift(rng, 2)
+        inside = 0
+        for first in range(0, n, chunk_size):
+            inside += count_inside_pairs(points(first, min(chunk_size, n - first), u))
+        estimates.append(4.0 * inside / n)
+    return replicate_estimate(estimates)
+
+def estimate_stratified(n_samples, rnd_seed, chunk_size, replicates=REPLICATES):
+    '''one uniform sample in every cell of the largest k x k grid on the
+    unit square with k*k <= n_samples // replicates, per replicate, the other
+    n_samples - replicates*k*k samples are not used'''
+    if n_samples < replicates:
+        raise ValueError('need at least %d samples, one per replicate' % replicates)
+    rng = np.random.RandomState(rnd_seed)
+    k = int(np.sqrt(n_samples // replicates))
+    while (k + 1)**2 <= n_samples // replicates:
+        k += 1
+    rows = max(1, chunk_size // k)
+    estimates = []
+    for r in range(replicates):
+        inside = 0
+        for row in range(0, k, rows):
+            m = min(rows, k - row)
+            xy = rng.random_sample((m * k, 2))
+            xy[:, 0] += np.repeat(np.arange(row, row + m), k)
+            xy[:, 1] += np.tile(np.arange(k), m)
+            xy /= k
+            inside += count_inside_pairs(xy)
+        estimates.append(4.0 * inside / (k * k))
+    return replicate_estimate(estimates)
+
+def estimate_antithetic(n_samples, rnd_seed, chunk_size):
+    '''n_samples // 2 uniform points (x, y), each paired with (1-x, 1-y), the
+    error comes from the sample variance of the pair averages. With an odd
+    n_samples the last sample is not used.'''
+    if n_samples < 4:
+        raise ValueError('need at least 4 samples, two antithetic pairs')
+    rng = np.random.RandomState(rnd_seed)
+    n = n_samples // 2
+    # number of pairs with 0, 1 and 2 of their points inside
+    hits = np.zeros(3, dtype=np.int64)
+    for first in range(0, n, chunk_size):
+        hits += count_antithetic(rng.random_sample((min(chunk_size, n - first), 2)))
+    f = np.array([0.0, 2.0, 4.0])
+    mean = np.dot(hits, f) / n
+    var = np.dot(hits, (f - mean)**2) / (n - 1)
+    return mean, np.sqrt(var / n)
+
+def uniform_error(estimate, n_samples):
+    '''standard error of a plain estimate, 4 times a binomial proportion'''
+    if n_samples < 2:
+        return np.inf
+    return np.sqrt(estimate * (4.0 - estimate) / (n_samples - 1))
+
+SAMPLERS = ['uniform', 'antithetic', 'stratified', 'sobol', 'halton']
+
+def z_value(confidence):
+    '''z such that a normal variable is within z standard deviations of its
+    mean with probability confidence, found by bisection on erf'''
+    low, high = 0.0, 40.0
+    for i in range(100):
+        z = 0.5 * (low + high)
+        if math.erf(z / math.sqrt(2.0)) < confidence:
+            low = z
+        else:
+            high = z
+    return 0.5 * (low + high)
+
+def batch_sums(sampler, rnd_seed, chunk_size, max_samples=None):
+    '''yields (samples, sum f, sum f**2) per batch of at most chunk_size
+    samples until max_samples are used. Uniform batches walk the block
+    streams, so the first n samples are those of estimate_pi(n, rnd_seed,
+    processes=...), antithetic batches are pairs of samples.'''
+    used = 0
+    if sampler == 'uniform':
+        block = 0
+        while max_samples is None or used < max_samples:
+            rng = block_rng(rnd_seed, block)
+            for first in range(0, BLOCK_SIZE, chunk_size):
+                n = min(chunk_size, BLOCK_SIZE - first)
+                if max_samples is not None:
+                    n = min(n, max_samples - used)
+                if n <= 0:
+                    return
+                inside = count_inside_pairs(rng.random_sample((n, 2)))
+                used += n
+                yield n, 4.0 * inside, 16.0 * inside
+            block += 1
+    elif sampler == 'antithetic':
+        rng = np.random.RandomState(rnd_seed)
+        while max_samples is None or used + 2 <= max_samples:
+            n = chunk_size // 2
+            if max_samples is not None:
+                n = min(n, (max_samples - used) // 2)
+            hits = count_antithetic(rng.random_sample((n, 2)))
+            used += 2 * n
+            # pair averages are 0, 2 or 4, counted once per pair
+            yield 2 * n, 2.0 * (hits[1] * 2.0 + hits[2] * 4.0), 2.0 * (hits[1] * 4.0 + hits[2] * 16.0)
+    else:
+        raise ValueError('sequential estimates need a uniform or antithetic sampler, not %r' % (sampler,))
+
+def estimate_pi_sequential(target_error,confidence=0.95,max_samples=None,max_time=None,
+                           rnd_seed=0,chunk_size=2**20,sampler='uniform'):
+    '''Draws batches until the confidence interval of the estimate is at most
+    target_error either side of it, or max_samples or max_time seconds are
+    used up. Returns (estimate, (low, high), samples used, elapsed time).'''
+    if sampler not in ('uniform', 'antithetic'):
+        raise ValueError('sequential estimates need a uniform or antithetic sampler, not %r' % (sampler,))
+    # antithetic sums count each pair average twice, so a pair is one
+    # observation of the pair average
+    per_observation = 2 if sampler == 'antithetic' else 1
+    # every batch needs a sample, or a pair of them
+    if chunk_size < per_observation:
+        raise ValueError('chunk_size must be at least %d for the %s sampler' % (per_observation, sampler))
+    if max_samples is not None and max_samples < per_observation:
+        raise ValueError('max_samples must be at least %d for the %s sampler' % (per_observation, sampler))
+    start = time.time()
+    z = z_value(confidence)
+    n = 0
+    total = 0.0
+    total_sq = 0.0
+    half_width = np.inf
+    for m, f, f_sq in batch_sums(sampler, rnd_seed, chunk_size, max_samples):
+        n += m
+        total += f
+        total_sq += f_sq
+        observations = n // per_observation
+        mean = total / n
+        if observations > 1:
+            var = (total_sq / n - mean**2) * observations / (observations - 1)
+            # an all hit or all miss start has no variance to go by yet
+            if var > 0:
+                half_width = z * math.sqrt(var / observations)
+                if half_width <= target_error:
+                    break
+        if max_time is not None and time.time() - start >= max_time:
+            break
+    return mean, (mean - half_width, mean + half_width), n, time.time() - start
+
+def estimate_pi(n_samples,rnd_seed=0,chunk_size=2**20,processes=None,sampler='uniform',error=False,
+                target_error=None,confidence=0.95,max_time=None):
+    # sampler is one of SAMPLERS, with error=True the standard error of the
+    # estimate is returned along with it. processes only applies to uniform.
+    # With a target_error n_samples is only the most samples to draw, see
+    # estimate_pi_sequential for what is returned.
+    if target_error is not None:
+        return estimate_pi_sequential(target_error, confidence, n_samples, max_time,
+                                      rnd_seed, chunk_size, sampler)
+    if sampler == 'antithetic':
+        result = estimate_antithetic(n_samples, rnd_seed, chunk_size)
+    elif sampler == 'stratified':
+        result = estimate_stratified(n_samples, rnd_seed, chunk_size)
+    elif sampler == 'sobol':
+        result = estimate_qmc(sobol_points, sobol_shift, n_samples, rnd_seed, chunk_size)
+    elif sampler == 'halton':
+        result = estimate_qmc(halton_points, halton_shift, n_samples, rnd_seed, chunk_size)
+    elif sampler == 'uniform':
+        estimate = estimate_uniform(n_samples, rnd_seed, chunk_size, processes)
+        result = estimate, uniform_error(estimate, n_samples)
+    else:
+        raise ValueError('unknown sampler %r' % (sampler,))
+    return result if error else result[0]
+
+def estimate_uniform(n_samples,rnd_seed,chunk_size,processes):
+    # With processes set the samples come from independent per block streams
+    # (see BLOCK_SIZE) counted by that many worker processes, the result is
+    # the same for any number of processes.
+    if processes is not None:
+        return integrate(quarter_disc, 2, n_samples, rnd_seed, chunk_size, processes)[0]
+
+    # Otherwise uses the same samples as drawing all x and then all y after
+    # np.random.seed(rnd_seed), but only chunk_size of them at a time
+    rng_x = np.random.RandomState(rnd_seed)
+    rng_y = np.random.RandomState(rnd_seed)
+    for first in range(0, n_samples, chunk_size):
+        rng_y.random_sample(min(chunk_size, n_samples - first))
+
+    inside = 0
+    for first in range(0, n_samples, chunk_size):
+        n = min(chunk_size, n_samples - first)
+        inside += count_inside(rng_x.random_sample(n), rng_y.random_sample(n))
+    return 4.0 * inside / float(n_samples)
+
+def convergence_sweep(checkpoints,n_runs=N_RUNS,chunk_size=2**20,processes=1):
+    '''Estimates after the first n samples of a single sample stream per run,
+    for every n in checkpoints, as an (n_runs, len(checkpoints)) array. Run r
+    uses the streams of estimate_pi(n, r, processes=...), so every estimate
+    equals that call, but the sweep only draws max(checkpoints) samples per
+    run.'''
+    checkpoints = np.sort(np.asarray(checkpoints, dtype=np.int64))
+    n_max = int(checkpoints[-1])
+
+    tasks = []
+    for run in range(n_runs):
+        for b, first in enumerate(range(0, n_max, BLOCK_SIZE)):
+            offsets = np.clip(checkpoints - first, 0, BLOCK_SIZE).tolist()
+            tasks.append((run, b, offsets, chunk_size))
+    counts = np.array(map_blocks(count_block_prefixes, tasks, processes))
+
+    inside = np.zeros((n_runs, len(checkpoints)), dtype=np.int64)
+    for (run, b, offsets, chunk), c in zip(tasks, counts):
+        inside[run] += c
+    return 4.0 * inside / checkpoints.astype(np.float64)
+
+def compare_samplers(sizes, samplers=SAMPLERS, rnd_seed=0):
+    '''prints the actual and estimated error and the time taken by every
+    sampler at every sample count in sizes'''
+    print "%-11s %10s %12s %10s %10s %8s" % ("sampler", "samples", "estimate", "error", "std err", "seconds")
+    for sampler in samplers:
+        for n_samples in sizes:
+            start = time.time()
+            estimate, err = estimate_pi(n_samples, rnd_seed, sampler=sampler, error=True)
+            elapsed = time.time() - start
+            print "%-11s %10d %12.9f %10.3e %10.3e %8.3f" % (
+                sampler, n_samples, estimate, abs(estimate - np.pi), err, elapsed)
+
+def main():
+    # --processes=N spreads the sweep over N worker processes
+    processes = 1
+    for arg in sys.argv[1:]:
+        if arg.startswith('--processes='):
+            processes = int(arg.split('=', 1)[1])
+
+    # --target=E estimates to within E at 95% confidence instead
+    for arg in sys.argv[1:]:
+        if arg.startswith('--target='):
+            estimate, interval, n_used, elapsed = estimate_pi(10**10, target_error=float(arg.split('=', 1)[1]))
+            print "Estimate", estimate, "interval", interval, "samples", n_used, "seconds", elapsed
+            return
+
+    # --compare prints the error against time of every sampler instead
+    if '--compare' in sys.argv[1:]:
+        compare_samplers([pow(10,i) for i in range(3,8)])
+        return
+
+    # every sample count is a prefix of the same per run sample stream
+    sizes = [pow(10,i) for i in range(2,9)]
+    estimates = convergence_sweep(sizes, N_RUNS, processes=processes)
+
+    averages = []
+    deviation = []
+    for k, n_samples in enumerate(sizes):
+        approx = estimates[:, k].tolist()
+        print "Aproximation", approx,n_samples
+        average = np.mean(approx)
+        averages.append(average)
+        deviation.append(np.abs(np.array(approx) - average))
+
+    deviation = np.array(deviation)
+    print "Averages: ", averages
+    print "Deviation from average", deviation
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Offline rendering for the FuncAnimation based models
+
+The simulation is run ahead of time without a display, the frames are
+then drawn by a pool of worker processes and piped to ffmpeg in order.
+"""
+
+import sys
+import errno
+import subprocess
+import multiprocessing
+
+# set in every worker by init_worker
+worker_draw = None
+worker_frames = None
+
+def render_requested(argv=sys.argv):
+    return '--render' in argv
+
+def option(name, default, argv=sys.argv):
+    # value of a --name=value command line option
+    for arg in argv[1:]:
+        if arg.startswith('--' + name + '='):
+            return type(default)(arg.split('=', 1)[1])
+    return default
+
+def init_worker(draw, frames):
+    global worker_draw, worker_frames
+    worker_draw = draw
+    worker_frames = frames
+
+def render_frame(i):
+    fig = worker_draw(i, worker_frames[i])
+    fig.canvas.draw()
+    return fig.canvas.tostring_rgb()
+
+def encoder_command(filename, width, height, fps):
+    return ['ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '%dx%d' % (width, height), '-r', str(fps),
+            '-i', '-', '-vcodec', 'libx264', '-pix_fmt', 'yuv420p', filename]
+
+def render_video(filename, fig, draw, frames, fps=30, processes=None, chunksize=16, command=None):
+    '''Renders one video frame per element of frames. draw(i, frame) must
+    update the artists of fig for frame i and return fig; it runs in the
+    worker processes, so it has to be a module level function. The frames
+    are encoded in order as they become available. Returns the encoder's
+    exit code, which is not 0 if encoding failed.'''
+    fig.canvas.draw()
+    width, height = fig.canvas.get_width_height()
+    if command is None:
+        command = encoder_command(filename, width, height, fps)
+    encoder = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(draw, frames))
+    finished = False
+    broken_pipe = False
+    try:
+        for image in pool.imap(render_frame, range(len(frames)), chunksize):
+            encoder.stdin.write(image)
+        finished = True
+    except IOError as e:
+        # the encoder stopped reading, its exit code tells why
+        if e.errno != errno.EPIPE:
+            raise
+        broken_pipe = True
+    finally:
+        # on any error the frames still queued are dropped, not drawn
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+        try:
+            encoder.stdin.close()
+        except IOError:
+            broken_pipe = True
+        encoder.wait()
+    if broken_pipe and encoder.returncode == 0:
+        return 1
+    return encoder.returncode
+
+def exit_on_failure(returncode):
+    '''exits with an error if render_video's returncode says it failed'''
+    if returncode != 0:
+        sys.exit("encoding the video failed, encoder exit code %d" % returncode)